@@ -24,12 +24,15 @@ import xml.etree.ElementTree as ElementTree
 
 import utils
 import sequenceGet
+import wgsIndex
 
 REPLICON = 'assembled-molecule'
 UNLOCALISED = 'unlocalised-scaffold'
 UNPLACED = 'unplaced-scaffold'
 PATCH = 'patch'
 
+WGS_READ_BLOCK_SIZE = 4 * 1024 * 1024
+
 
 def check_format(output_format):
     if output_format not in [utils.EMBL_FORMAT, utils.FASTA_FORMAT]:
@@ -69,43 +72,86 @@ def parse_assembly_xml(xml_file):
     return wgs_set, sequence_report
 
 
-def parse_sequence_report(local_sequence_report):
-    f = open(local_sequence_report)
-    lines = f.readlines()
-    f.close()
-    replicon_list = [l.split('\t')[0] for l in lines[1:] if l.split('\t')[3] == REPLICON]
-    unlocalised_list = [l.split('\t')[0] for l in lines[1:] if l.split('\t')[3] == UNLOCALISED]
-    unplaced_list = [l.split('\t')[0] for l in lines[1:] if l.split('\t')[3] == UNPLACED]
-    patch_list = [l.split('\t')[0] for l in lines[1:] if PATCH in l.split('\t')[3]]
-    return replicon_list, unlocalised_list, unplaced_list, patch_list
+class AccessionList(object):
+    # accessions packed newline-separated into a single bytearray, which takes a
+    # fraction of the memory of a list holding one str object per accession
+
+    def __init__(self):
+        self.data = bytearray()
+        self.count = 0
+
+    def append(self, accession):
+        self.data += accession
+        self.data += b'\n'
+        self.count += 1
 
+    def __len__(self):
+        return self.count
 
-def extract_wgs_sequences(accession_list):
-    wgs_sequences = [a for a in accession_list if utils.is_wgs_sequence(a)]
-    other_sequences = [a for a in accession_list if not utils.is_wgs_sequence(a)]
-    return wgs_sequences, other_sequences
+    def __iter__(self):
+        data = self.data
+        start = 0
+        while start < len(data):
+            end = data.index(b'\n', start)
+            yield data[start:end].decode()
+            start = end + 1
+
+
+def parse_sequence_report(local_sequence_report):
+    # single pass over the report: each line is split once and its accession filed
+    # by sequence role, with WGS scaffolds kept apart for extraction from the WGS set
+    replicon_list = AccessionList()
+    unlocalised_list = AccessionList()
+    unplaced_list = AccessionList()
+    patch_list = AccessionList()
+    wgs_scaffolds = AccessionList()
+    replicon_role = REPLICON.encode()
+    unlocalised_role = UNLOCALISED.encode()
+    unplaced_role = UNPLACED.encode()
+    patch_role = PATCH.encode()
+    with open(local_sequence_report, 'rb') as f:
+        next(f, None)
+        for line in f:
+            fields = line.split(b'\t', 4)
+            if len(fields) < 4:
+                continue
+            accession = fields[0]
+            role = fields[3] if len(fields) > 4 else fields[3].rstrip()
+            if role == replicon_role:
+                replicon_list.append(accession)
+            elif role == unlocalised_role or role == unplaced_role:
+                if utils.wgs_sequence_bytes_pattern.match(accession):
+                    wgs_scaffolds.append(accession)
+                elif role == unlocalised_role:
+                    unlocalised_list.append(accession)
+                else:
+                    unplaced_list.append(accession)
+            elif patch_role in role:
+                patch_list.append(accession)
+    return replicon_list, unlocalised_list, unplaced_list, patch_list, wgs_scaffolds
 
 
 def download_sequence_set(accession_list, mol_type, assembly_dir, output_format, expanded, quiet):
     failed_accessions = []
-    count = 0
+    progress = {'count': 0}
     sequence_cnt = len(accession_list)
     divisor = utils.get_divisor(sequence_cnt)
+
+    def print_progress(batch, failed_batch):
+        previous_count = progress['count']
+        progress['count'] += len(batch) - len(failed_batch)
+        if progress['count'] // divisor > previous_count // divisor and not quiet:
+            print('downloaded {0} of {1} sequences'.format(progress['count'], sequence_cnt))
+
     if sequence_cnt > 0:
         if not quiet:
             print('fetching {0} sequences: {1}'.format(sequence_cnt, mol_type))
         target_file_path = os.path.join(assembly_dir, utils.get_filename(mol_type, output_format))
         target_file = open(target_file_path, 'wb')
-        for accession in accession_list:
-            success = sequenceGet.write_record(target_file, accession, output_format, expanded)
-            if not success:
-                failed_accessions.append(accession)
-            else:
-                count += 1
-                if count % divisor == 0 and not quiet:
-                    print('downloaded {0} of {1} sequences'.format(count, sequence_cnt))
+        failed_accessions = sequenceGet.write_record_batches(target_file, accession_list, output_format, expanded,
+                                                             print_progress)
         if not quiet:
-            print('downloaded {0} of {1} sequences'.format(count, sequence_cnt))
+            print('downloaded {0} of {1} sequences'.format(progress['count'], sequence_cnt))
         target_file.close()
     elif not quiet:
         print('no sequences: ' + mol_type)
@@ -116,37 +162,53 @@ def download_sequence_set(accession_list, mol_type, assembly_dir, output_format,
 
 def download_sequences(sequence_report, assembly_dir, output_format, expanded, quiet):
     local_sequence_report = os.path.join(assembly_dir, sequence_report)
-    replicon_list, unlocalised_list, unplaced_list, patch_list = parse_sequence_report(local_sequence_report)
-    wgs_scaffolds, other_unlocalised = extract_wgs_sequences(unlocalised_list)
-    wgs_unplaced, other_unplaced = extract_wgs_sequences(unplaced_list)
+    replicon_list, unlocalised_list, unplaced_list, patch_list, wgs_scaffolds = parse_sequence_report(
+        local_sequence_report)
     download_sequence_set(replicon_list, REPLICON, assembly_dir, output_format, expanded, quiet)
-    download_sequence_set(other_unlocalised, UNLOCALISED, assembly_dir, output_format, expanded, quiet)
-    download_sequence_set(other_unplaced, UNPLACED, assembly_dir, output_format, expanded, quiet)
+    download_sequence_set(unlocalised_list, UNLOCALISED, assembly_dir, output_format, expanded, quiet)
+    download_sequence_set(unplaced_list, UNPLACED, assembly_dir, output_format, expanded, quiet)
     download_sequence_set(patch_list, PATCH, assembly_dir, output_format, expanded, quiet)
-    wgs_scaffolds.extend(wgs_unplaced)
     return wgs_scaffolds
 
 
 def extract_wgs_scaffolds(assembly_dir, wgs_scaffolds, wgs_set, output_format, quiet):
     if not quiet:
         print('extracting {0} WGS scaffolds from WGS set file'.format(len(wgs_scaffolds)))
-    accs = [a.split('.')[0] for a in wgs_scaffolds]
     wgs_file_path = os.path.join(assembly_dir, wgs_set + utils.get_wgs_file_ext(output_format))
     target_file_path = os.path.join(assembly_dir, utils.get_filename('wgs_scaffolds', output_format))
-    write_line = False
-    target_file = open(target_file_path, 'w')
-    with gzip.open(wgs_file_path, 'rb') as f:
-        for line in f:
-            if utils.record_start_line(line, output_format):
-                if utils.extract_acc_from_line(line, output_format) in accs:
-                    write_line = True
-                else:
-                    write_line = False
-                    target_file.flush()
-            if write_line:
-                target_file.write(line)
-    target_file.flush()
-    target_file.close()
+    if wgsIndex.has_index(wgs_file_path):
+        with open(target_file_path, 'wb') as target_file:
+            missing = wgsIndex.fetch_records(wgs_file_path, wgs_scaffolds, target_file)
+    else:
+        missing = extract_wgs_records(wgs_file_path, target_file_path, wgs_scaffolds)
+    if len(missing) > 0:
+        print('Failed to find following WGS scaffolds in WGS set file')
+        print(','.join(missing))
+
+
+def extract_wgs_records(wgs_file_path, target_file_path, wgs_scaffolds):
+    # single pass over the whole WGS set file, returns the accessions not found
+    remaining = set(a.split('.')[0].encode() for a in wgs_scaffolds)
+    extracting = False
+    with gzip.open(wgs_file_path, 'rb') as f, open(target_file_path, 'wb') as target_file:
+        for block in utils.read_line_blocks(f, WGS_READ_BLOCK_SIZE):
+            record_start = 0
+            for header_start, header in utils.find_header_lines(block):
+                if extracting:
+                    target_file.write(block[record_start:header_start])
+                if not remaining:
+                    # every requested scaffold has been written, no need to read further
+                    extracting = False
+                    break
+                accession = utils.get_header_accession(header)
+                extracting = accession in remaining
+                remaining.discard(accession)
+                record_start = header_start
+            if extracting:
+                target_file.write(block[record_start:])
+            elif not remaining:
+                break
+    return sorted(a.decode() for a in remaining)
 
 
 def download_assembly(dest_dir, accession, output_format, fetch_wgs, extract_wgs, expanded, quiet=False):
@@ -160,7 +222,7 @@ def download_assembly(dest_dir, accession, output_format, fetch_wgs, extract_wgs
     has_sequence_report = False
     # download sequence report
     if sequence_report is not None:
-        has_sequence_report = utils.get_ftp_file(sequence_report, assembly_dir)
+        has_sequence_report = utils.get_ftp_file(sequence_report, assembly_dir, accession)
     # parse sequence report and download sequences
     wgs_scaffolds = []
     wgs_scaffold_cnt = 0
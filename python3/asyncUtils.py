@@ -0,0 +1,204 @@
+#
+# asyncUtils.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# asyncio transfer backend, selected with --asyncio. Sequence record fetches and
+# the portal queries of a group run as coroutines on one event loop, with at
+# most utils.ASYNC_CONCURRENCY requests in flight. Read and analysis files are
+# fetched over FTP or Aspera and do not use it. Requires aiohttp.
+
+import asyncio
+import collections
+import os
+import sys
+import time
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import utils
+
+
+def is_supported():
+    return aiohttp is not None
+
+
+async def call_with_retries(url, func):
+    # utils.call_with_retries for coroutines: the same attempt limit, backoff and circuit breaker
+    host = utils.get_host(url)
+    retries = 0
+    while True:
+        utils.check_circuit(host)
+        try:
+            result = await func(retries)
+        except Exception as e:
+            retries += 1
+            delay = utils.get_attempt_retry_delay(url, e, retries)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+        else:
+            utils.record_host_result(host, False)
+            return result
+
+
+def raise_for_retry_status(response):
+    # a status worth retrying is raised, as aiohttp.ClientResponseError, for call_with_retries
+    if response.status in utils.RETRY_STATUS_CODES:
+        response.raise_for_status()
+
+
+def new_session():
+    timeout = aiohttp.ClientTimeout(sock_connect=utils.HTTP_CONNECT_TIMEOUT, sock_read=utils.HTTP_READ_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=utils.ASYNC_CONCURRENCY)
+    return aiohttp.ClientSession(timeout=timeout, connector=connector)
+
+
+async def fetch_records(session, semaphore, accession_list, output_format, expanded, count_records=True):
+    # body holding the requested records, or None if any of them is missing
+    url = utils.get_records_url(accession_list, output_format)
+    if expanded:
+        url = url + '?expanded=true'
+    async def attempt(retries):
+        async with session.get(url) as response:
+            raise_for_retry_status(response)
+            if response.status != 200:
+                return None
+            return await response.read()
+
+    async with semaphore:
+        start = time.time()
+        try:
+            body = await call_with_retries(url, attempt)
+        except (aiohttp.ClientError, asyncio.TimeoutError, utils.CircuitOpenError) as e:
+            record_fetch(url, start, b'', accession_list, e)
+            return None
+        if body is None:
+            record_fetch(url, start, b'', accession_list, 'HTTPError')
+            return None
+    if body.startswith(b'Entry:'):
+        record_fetch(url, start, b'', accession_list, 'RecordNotFound')
+        return None
+    if count_records and sum(1 for header in utils.find_header_lines(body)) != len(accession_list):
+        record_fetch(url, start, body, accession_list, 'IncompleteBatch')
+        return None
+    record_fetch(url, start, body, accession_list)
+    return body
+
+
+def record_fetch(url, start, body, accession_list, error=None):
+    if len(accession_list) == 1:
+        utils.record_transfer(url, utils.get_protocol(url), start, len(body), accession_list[0], error=error)
+    else:
+        utils.record_transfer(url, utils.get_protocol(url), start, len(body), error=error, records=len(accession_list))
+
+
+async def fetch_record_batch(session, semaphore, batch, output_format, expanded):
+    body = await fetch_records(session, semaphore, batch, output_format, expanded)
+    if body is not None:
+        return body, []
+    # fall back to one request per accession to find out which ones are failing
+    bodies = await asyncio.gather(*[fetch_records(session, semaphore, [accession], output_format, expanded, False)
+                                    for accession in batch])
+    return b''.join(b for b in bodies if b is not None), [a for a, b in zip(batch, bodies) if b is None]
+
+
+async def write_record_batches_async(dest_file, batches, output_format, expanded, on_batch):
+    semaphore = asyncio.Semaphore(utils.ASYNC_CONCURRENCY)
+    failed_accessions = []
+    pending = collections.deque()
+
+    async def write_next():
+        batch, task = pending.popleft()
+        body, failed_batch = await task
+        dest_file.write(body)
+        failed_accessions.extend(failed_batch)
+        if on_batch is not None:
+            on_batch(batch, failed_batch)
+
+    async with new_session() as session:
+        for batch in batches:
+            task = asyncio.ensure_future(fetch_record_batch(session, semaphore, batch, output_format, expanded))
+            pending.append((batch, task))
+            # batches are written in order, so only keep a bounded window in memory
+            if len(pending) >= 2 * utils.ASYNC_CONCURRENCY:
+                await write_next()
+        while pending:
+            await write_next()
+    dest_file.flush()
+    return failed_accessions
+
+
+def write_record_batches(dest_file, batches, output_format, expanded=False, on_batch=None):
+    return asyncio.run(write_record_batches_async(dest_file, batches, output_format, expanded, on_batch))
+
+
+async def download_report(session, semaphore, url, dest_file_path):
+    async def attempt(retries):
+        async with session.get(url) as response:
+            if response.status != 200:
+                if retries + 1 < utils.RETRY_ATTEMPTS:
+                    raise_for_retry_status(response)
+                return response.status, response.reason
+            with open(dest_file_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(utils.HTTP_BUFFER_SIZE):
+                    f.write(chunk)
+            return response.status, response.reason
+
+    async with semaphore:
+        return await call_with_retries(url, attempt)
+
+
+async def download_reports_async(reports):
+    semaphore = asyncio.Semaphore(utils.ASYNC_CONCURRENCY)
+    async with new_session() as session:
+        return await asyncio.gather(*[download_report(session, semaphore, url, dest_file_path)
+                                      for url, dest_file_path in reports])
+
+
+def download_reports(reports):
+    # fetches several portal reports at once, each given as (url, destination file path)
+    uncached = []
+    for url, dest_file_path in reports:
+        body = utils.get_cached_response(url)
+        if body is None:
+            uncached.append((url, dest_file_path))
+        else:
+            with open(dest_file_path, 'wb') as f:
+                f.write(body)
+    reports = uncached
+    try:
+        responses = asyncio.run(download_reports_async(reports))
+    except aiohttp.ClientConnectorCertificateError as e:
+        utils.print_certificate_failed_error(e)
+        return
+    for (url, dest_file_path), (status, reason) in zip(reports, responses):
+        if status == 204:
+            sys.stderr.write('ERROR: No records of the requested data group are available associated with the '
+                             'provided accession')
+            sys.exit(1)
+        elif status != 200:
+            sys.stderr.write('ERROR: ' + str(reason) + '\n')
+            sys.stderr.write('ERROR: Unable to fetch data from url: ' + url + '\n')
+            sys.exit(1)
+        if os.path.getsize(dest_file_path) <= utils.RESPONSE_CACHE_ENTRY_SIZE:
+            with open(dest_file_path, 'rb') as f:
+                utils.cache_response(url, f.read())
+
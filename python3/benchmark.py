@@ -0,0 +1,582 @@
+#
+# benchmark.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Throughput benchmark that never touches EBI. Local stand-ins for the browser
+# API, the portal search API and the FTP servers serve a synthetic dataset, and
+# enaDataGet/enaGroupGet are run against them in a process of their own for a
+# set of scenarios. Wall time, bytes/s, requests/s and peak RSS are reported for
+# each, and can be saved and compared with an earlier run.
+
+import argparse
+import gzip
+import hashlib
+import http.server
+import json
+import os
+import posixpath
+import re
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse as urlparse
+
+CHILD_ENV = 'ENA_BENCHMARK_CONFIG'
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STUDY = 'PRJEB1'
+TAXON = '9606'
+ASSEMBLY = 'GCA_000000001.1'
+WGS_PREFIX = 'AAAA'
+HUGE_RUN = 'ERR9000001'
+RECORD_LENGTH = 1000  # bases per synthetic sequence record
+
+SCENARIOS = {
+    'records': 'enaGroupGet -g sequence for a taxon with RECORDS sequence records',
+    'huge-files': 'enaDataGet for a run with HUGE_FILES read files of HUGE_FILE_SIZE MB',
+    'run-list': 'enaDataGet --accession-file for a list of RUNS runs of FILES_PER_RUN files of FILE_SIZE KB',
+    'assembly': 'enaDataGet -e for an assembly with RECORDS sequences, half of them WGS scaffolds',
+    'read-group': 'enaGroupGet -g read for a study with RUNS runs of FILES_PER_RUN files of FILE_SIZE KB',
+}
+
+
+def get_run_accession(i):
+    return 'ERR{0:07d}'.format(i + 1)
+
+
+def get_replicon_accession(i):
+    return 'CM{0:06d}.1'.format(i + 1)
+
+
+def get_scaffold_accession(i):
+    return '{0}01{1:06d}'.format(WGS_PREFIX, i + 1)
+
+
+def get_sequence_accession(i):
+    return 'AB{0:06d}.1'.format(i + 1)
+
+
+def get_embl_record(accession):
+    lines = ['ID   {0}; SV 1; linear; genomic DNA; STD; SYN; {1} BP.'.format(accession.split('.')[0], RECORD_LENGTH),
+             'XX', 'AC   {0};'.format(accession.split('.')[0]), 'XX',
+             'SQ   Sequence {0} BP;'.format(RECORD_LENGTH)]
+    for start in range(0, RECORD_LENGTH, 60):
+        lines.append('     ' + ' '.join(['acgtacgtac'] * 6) + ' {0:>9}'.format(min(start + 60, RECORD_LENGTH)))
+    return ('\n'.join(lines) + '\n//\n').encode()
+
+
+def get_fasta_record(accession):
+    sequence = 'ACGT' * (RECORD_LENGTH // 4)
+    return ('>ENA|{0}|{0} synthetic sequence\n'.format(accession)
+            + '\n'.join(sequence[i:i + 60] for i in range(0, len(sequence), 60)) + '\n').encode()
+
+
+def write_file(path, size):
+    # random content, so that nothing along the way can compress it; returns the md5
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    block = os.urandom(min(size, 1024 * 1024))
+    hash_md5 = hashlib.md5()
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            data = block[:remaining]
+            f.write(data)
+            hash_md5.update(data)
+            remaining -= len(data)
+    return hash_md5.hexdigest()
+
+
+class Dataset(object):
+    # the synthetic files served over FTP, and what the portal knows about them
+
+    def __init__(self, root, args):
+        self.root = root
+        self.record_cnt = args.records
+        self.runs = {}
+        for i in range(args.runs):
+            self.add_run(get_run_accession(i), args.files_per_run, args.file_size * 1024)
+        self.add_run(HUGE_RUN, args.huge_files, args.huge_file_size * 1024 * 1024)
+        self.write_assembly()
+        self.run_list_path = os.path.join(os.path.dirname(root), 'run_list.txt')
+        with open(self.run_list_path, 'w') as f:
+            f.write(''.join(run_accession + '\n' for run_accession in self.runs if run_accession != HUGE_RUN))
+
+    def add_run(self, run_accession, file_cnt, size):
+        files = []
+        for j in range(file_cnt):
+            path = 'vol1/fastq/{0}/{1}/{1}_{2}.fastq.gz'.format(run_accession[:6], run_accession, j + 1)
+            files.append((path, write_file(os.path.join(self.root, path), size), size))
+        self.runs[run_accession] = files
+
+    def get_sequence_report_path(self):
+        return 'pub/databases/ena/assembly/{0}/{1}_sequence_report.txt'.format(ASSEMBLY[:7], ASSEMBLY)
+
+    def get_wgs_set_path(self):
+        return 'pub/databases/ena/wgs/public/{0}/{1}01.dat.gz'.format(WGS_PREFIX[:3].lower(), WGS_PREFIX)
+
+    def write_assembly(self):
+        replicon_cnt = self.record_cnt - self.record_cnt // 2
+        scaffold_cnt = self.record_cnt // 2
+        path = os.path.join(self.root, self.get_sequence_report_path())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write('accession\tsequence-name\tsequence-length\tsequence-role\treplicon-name\n')
+            for i in range(replicon_cnt):
+                f.write('{0}\tchr{1}\t{2}\tassembled-molecule\tchr{1}\n'.format(
+                    get_replicon_accession(i), i + 1, RECORD_LENGTH))
+            for i in range(scaffold_cnt):
+                f.write('{0}\tscaffold{1}\t{2}\tunplaced-scaffold\tna\n'.format(
+                    get_scaffold_accession(i), i + 1, RECORD_LENGTH))
+        path = os.path.join(self.root, self.get_wgs_set_path())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with gzip.open(path, 'wb', compresslevel=1) as f:
+            # the WGS set holds more contigs than the assembly uses
+            for i in range(scaffold_cnt * 2):
+                f.write(get_embl_record(get_scaffold_accession(i)))
+
+    def get_sequence_accessions(self, result):
+        # sequence_update and sequence_release overlap, as they do for real taxa
+        cnt = self.record_cnt
+        if result == 'sequence_update':
+            return [get_sequence_accession(i) for i in range(cnt * 3 // 5)]
+        return [get_sequence_accession(i) for i in range(cnt * 2 // 5, cnt)]
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def increment(self):
+        with self.lock:
+            self.value += 1
+
+
+class ViewHandler(http.server.BaseHTTPRequestHandler):
+    # browser API and portal search API
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, body, content_type='text/plain', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.increment()
+        time.sleep(self.server.latency)
+        url_parts = urlparse.urlsplit(self.path)
+        if url_parts.path.startswith('/browser/api/'):
+            self.browse(urlparse.unquote(url_parts.path[len('/browser/api/'):]))
+        elif url_parts.path.startswith('/portal/api/search'):
+            self.search(urlparse.parse_qs(url_parts.query))
+        else:
+            self.reply(b'', status=404)
+
+    def do_POST(self):
+        self.server.requests.increment()
+        time.sleep(self.server.latency)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self.search(urlparse.parse_qs(body))
+
+    def browse(self, path):
+        display, _, accessions = path.partition('/')
+        accessions = accessions.split(',')
+        if display == 'xml':
+            self.reply(self.get_xml(accessions[0]), 'application/xml')
+        elif display == 'embl':
+            self.reply(b''.join(get_embl_record(a) for a in accessions))
+        elif display == 'fasta':
+            self.reply(b''.join(get_fasta_record(a) for a in accessions))
+        else:
+            self.reply(b'', status=404)
+
+    def get_xml(self, accession):
+        if accession != ASSEMBLY:
+            return '<?xml version="1.0" encoding="UTF-8"?>\n<ROOT><RECORD accession="{0}"/></ROOT>\n'.format(
+                accession).encode()
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<ASSEMBLY_SET><ASSEMBLY accession="{0}">'
+                '<WGS_SET><PREFIX>{1}</PREFIX><VERSION>1</VERSION></WGS_SET><ASSEMBLY_LINKS><ASSEMBLY_LINK>'
+                '<URL_LINK><LABEL>Sequence Report</LABEL><URL>{2}/{3}</URL></URL_LINK>'
+                '</ASSEMBLY_LINK></ASSEMBLY_LINKS></ASSEMBLY></ASSEMBLY_SET>\n').format(
+            ASSEMBLY, WGS_PREFIX, self.server.ftp_url, self.server.dataset.get_sequence_report_path()).encode()
+
+    def search(self, params):
+        query = params.get('query', [''])[0]
+        result = params.get('result', [''])[0]
+        fields = params.get('fields', [''])[0].split(',')
+        dataset = self.server.dataset
+        if params.get('format', [''])[0] == 'json':
+            rows = []
+            run_accessions = re.findall(r'run_accession="([^"]+)"', query)
+            if len(run_accessions) == 0:
+                # the files of the whole study, for the size of the read group
+                run_accessions = [r for r in dataset.runs if r != HUGE_RUN]
+            for run_accession in run_accessions:
+                if run_accession in dataset.runs:
+                    rows.append(self.get_file_row(run_accession, fields))
+            self.reply(json.dumps(rows).encode(), 'application/json')
+        elif result in ['sequence_update', 'sequence_release']:
+            accessions = dataset.get_sequence_accessions(result)
+            self.reply(('accession\n' + ''.join(a + '\n' for a in accessions)).encode())
+        elif result == 'assembly':
+            self.reply(('accession\n' + ASSEMBLY + '\n').encode())
+        elif fields == ['experiment_accession']:
+            run_accession = re.findall(r'run_accession="([^"]+)"', query)[0]
+            self.reply('run_accession\texperiment_accession\n{0}\tERX{1}\n'.format(
+                run_accession, run_accession[3:]).encode())
+        elif result == 'read_run':
+            runs = [r for r in dataset.runs if r != HUGE_RUN]
+            self.reply(('run_accession\n' + ''.join(r + '\n' for r in runs)).encode())
+        else:
+            self.reply(fields[0].encode() + b'\n')
+
+    def get_file_row(self, run_accession, fields):
+        row = dict((field, '') for field in fields)
+        row['run_accession'] = run_accession
+        files = self.server.dataset.runs[run_accession]
+        row['fastq_ftp'] = ';'.join(self.server.ftp_host + '/' + path for path, md5, size in files)
+        row['fastq_md5'] = ';'.join(md5 for path, md5, size in files)
+        if 'fastq_bytes' in fields:
+            row['fastq_bytes'] = ';'.join(str(size) for path, md5, size in files)
+        return row
+
+
+class FtpHandler(socketserver.StreamRequestHandler):
+    # just enough of RFC 959 for ftplib: anonymous login, SIZE, REST, RETR and NLST in passive mode
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        self.rest = 0
+        self.data_listener = None
+        self.reply('220 enaBrowserTools benchmark FTP stand-in')
+        for line in self.rfile:
+            command, _, arg = line.decode().rstrip('\r\n').partition(' ')
+            self.server.requests.increment()
+            time.sleep(self.server.latency)
+            handler = getattr(self, 'ftp_' + command.upper(), None)
+            if handler is None:
+                self.reply('502 Command not implemented')
+            elif handler(arg) is False:
+                break
+        if self.data_listener is not None:
+            self.data_listener.close()
+
+    def get_local_path(self, arg):
+        return os.path.join(self.server.dataset.root, posixpath.normpath('/' + arg).lstrip('/'))
+
+    def ftp_USER(self, arg):
+        self.reply('331 Anonymous login ok, send your email as password')
+
+    def ftp_PASS(self, arg):
+        self.reply('230 Login successful')
+
+    def ftp_TYPE(self, arg):
+        self.reply('200 Type set to ' + arg)
+
+    def ftp_NOOP(self, arg):
+        self.reply('200 NOOP ok')
+
+    def ftp_SYST(self, arg):
+        self.reply('215 UNIX Type: L8')
+
+    def ftp_PWD(self, arg):
+        self.reply('257 "/" is the current directory')
+
+    def ftp_CWD(self, arg):
+        if os.path.isdir(self.get_local_path(arg)):
+            self.reply('250 Directory changed')
+        else:
+            self.reply('550 No such directory')
+
+    def ftp_QUIT(self, arg):
+        self.reply('221 Goodbye')
+        return False
+
+    def ftp_SIZE(self, arg):
+        path = self.get_local_path(arg)
+        if os.path.isfile(path):
+            self.reply('213 {0}'.format(os.path.getsize(path)))
+        else:
+            self.reply('550 No such file')
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply('350 Restarting at {0}'.format(self.rest))
+
+    def open_listener(self):
+        if self.data_listener is not None:
+            self.data_listener.close()
+        self.data_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.data_listener.bind(('127.0.0.1', 0))
+        self.data_listener.listen(1)
+        self.data_listener.settimeout(30)
+        return self.data_listener.getsockname()[1]
+
+    def ftp_PASV(self, arg):
+        port = self.open_listener()
+        self.reply('227 Entering Passive Mode (127,0,0,1,{0},{1})'.format(port >> 8, port & 0xff))
+
+    def ftp_EPSV(self, arg):
+        self.reply('229 Entering Extended Passive Mode (|||{0}|)'.format(self.open_listener()))
+
+    def send_data(self, chunks):
+        if self.data_listener is None:
+            self.reply('425 Use PASV first')
+            return
+        self.reply('150 Opening data connection')
+        conn, address = self.data_listener.accept()
+        self.data_listener.close()
+        self.data_listener = None
+        rate = self.server.rate
+        start = time.time()
+        sent = 0
+        try:
+            with conn:
+                for chunk in chunks:
+                    conn.sendall(chunk)
+                    sent += len(chunk)
+                    if rate > 0:
+                        delay = sent / rate - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+            self.reply('226 Transfer complete')
+        except OSError:
+            # the client closed the data connection early, as segmented downloads do
+            self.reply('426 Connection closed; transfer aborted')
+
+    def ftp_RETR(self, arg):
+        path = self.get_local_path(arg)
+        rest = self.rest
+        self.rest = 0
+        if not os.path.isfile(path):
+            self.reply('550 No such file')
+            return
+
+        def read_chunks():
+            with open(path, 'rb') as f:
+                f.seek(rest)
+                for chunk in iter(lambda: f.read(256 * 1024), b''):
+                    yield chunk
+        self.send_data(read_chunks())
+
+    def ftp_NLST(self, arg):
+        path = self.get_local_path(arg)
+        if not os.path.isdir(path):
+            self.reply('550 No such directory')
+            return
+        self.send_data([''.join(name + '\r\n' for name in sorted(os.listdir(path))).encode()])
+
+
+class StandInServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, handler, dataset, latency, rate=0):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.dataset = dataset
+        self.latency = latency
+        self.rate = rate
+        self.requests = Counter()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+def start_stand_ins(dataset, args):
+    ftp_server = StandInServer(FtpHandler, dataset, args.latency / 1000.0, args.rate * 1024 * 1024)
+    view_server = StandInServer(ViewHandler, dataset, args.latency / 1000.0)
+    view_server.ftp_host = '127.0.0.1:{0}'.format(ftp_server.server_address[1])
+    view_server.ftp_url = 'ftp://' + view_server.ftp_host
+    return view_server, ftp_server
+
+
+def get_scenario_args(scenario, dest_dir, dataset):
+    if scenario == 'records':
+        return ['enaGroupGet.py', '-g', 'sequence', '-d', dest_dir, TAXON]
+    elif scenario == 'huge-files':
+        return ['enaDataGet.py', '-f', 'fastq', '-d', dest_dir, HUGE_RUN]
+    elif scenario == 'assembly':
+        return ['enaDataGet.py', '-e', '-d', dest_dir, ASSEMBLY]
+    elif scenario == 'read-group':
+        return ['enaGroupGet.py', '-g', 'read', '-f', 'fastq', '-d', dest_dir, STUDY]
+    elif scenario == 'run-list':
+        return ['enaDataGet.py', '-f', 'fastq', '-d', dest_dir, '--accession-file', dataset.run_list_path]
+
+
+def get_dir_size(dir_path):
+    size = 0
+    for dirpath, dirnames, files in os.walk(dir_path):
+        size += sum(os.path.getsize(os.path.join(dirpath, f)) for f in files)
+    return size
+
+
+def wait_for_process(process):
+    # exit code and peak RSS in bytes of the tool process
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return process.returncode, rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def run_scenario(scenario, work_dir, view_server, ftp_server, tool_args):
+    dest_dir = tempfile.mkdtemp(prefix=scenario + '_', dir=work_dir)
+    cache_dir = tempfile.mkdtemp(prefix='cache_', dir=work_dir)
+    config = {'view_url_base': view_server.base_url + 'browser/api/',
+              'portal_search_base': view_server.base_url + 'portal/api/search?',
+              'wgs_ftp_base': view_server.ftp_url + '/pub/databases/ena/wgs'}
+    env = dict(os.environ)
+    env[CHILD_ENV] = json.dumps(config)
+    env['ENA_CACHE_DIR'] = cache_dir
+    argv = get_scenario_args(scenario, dest_dir, view_server.dataset) + tool_args
+    log_path = os.path.join(work_dir, scenario + '.log')
+    requests_before = view_server.requests.value + ftp_server.requests.value
+    start = time.time()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        exit_code, peak_rss = wait_for_process(process)
+    wall_time = time.time() - start
+    requests = view_server.requests.value + ftp_server.requests.value - requests_before
+    size = get_dir_size(dest_dir)
+    shutil.rmtree(dest_dir)
+    shutil.rmtree(cache_dir)
+    if exit_code != 0:
+        with open(log_path) as log:
+            sys.stderr.write('ERROR: {0} exited with {1}, last lines of {2}:\n{3}'.format(
+                scenario, exit_code, log_path, ''.join(log.readlines()[-10:])))
+    return {'scenario': scenario, 'exit_code': exit_code, 'wall_time': wall_time, 'bytes': size,
+            'requests': requests, 'peak_rss': peak_rss}
+
+
+def format_result(result, baseline=None):
+    line = '{0:<12} {1:>8.2f} {2:>10.1f} {3:>9.2f} {4:>9} {5:>9.1f} {6:>9}'.format(
+        result['scenario'], result['wall_time'], result['bytes'] / 1e6, result['bytes'] / 1e6 / result['wall_time'],
+        result['requests'], result['requests'] / result['wall_time'],
+        '-' if result['peak_rss'] is None else '{0:.1f}'.format(result['peak_rss'] / 1e6))
+    if result['exit_code'] != 0:
+        line += '  FAILED'
+    elif baseline is not None:
+        line += '  {0:+.1f}% wall time'.format(100.0 * (result['wall_time'] / baseline['wall_time'] - 1))
+    return line
+
+
+def print_results(results, baselines):
+    print('{0:<12} {1:>8} {2:>10} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+        'scenario', 'wall s', 'MB', 'MB/s', 'requests', 'req/s', 'RSS MB'))
+    for result in results:
+        print(format_result(result, baselines.get(result['scenario'])))
+
+
+def run_tool(argv):
+    # runs in the tool process: points utils at the stand-ins, then runs the tool as its own script would
+    import runpy
+    import utils
+    config = json.loads(os.environ[CHILD_ENV])
+    utils.VIEW_URL_BASE = config['view_url_base']
+    utils.PORTAL_SEARCH_BASE = config['portal_search_base']
+    utils.WGS_FTP_BASE = config['wgs_ftp_base']
+    sys.argv = argv
+    runpy.run_path(os.path.join(SCRIPT_DIR, argv[0]), run_name='__main__')
+
+
+def set_parser():
+    parser = argparse.ArgumentParser(prog='benchmark',
+                                     description='Measure download throughput against local stand-ins for the ENA '
+                                                 'browser, portal and FTP servers')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='Scenarios to run (default is all): ' + '; '.join(
+                            '{0}: {1}'.format(name, SCENARIOS[name]) for name in sorted(SCENARIOS)))
+    parser.add_argument('--records', type=int, default=20000,
+                        help='Number of sequence records for the records and assembly scenarios (default is 20000)')
+    parser.add_argument('--runs', type=int, default=50, help='Number of runs in the read group and run list (default is 50)')
+    parser.add_argument('--files-per-run', type=int, default=2, help='Number of files per run (default is 2)')
+    parser.add_argument('--file-size', type=int, default=256, help='Size of each run file in KB (default is 256)')
+    parser.add_argument('--huge-files', type=int, default=2,
+                        help='Number of files of the huge-files run (default is 2)')
+    parser.add_argument('--huge-file-size', type=int, default=256,
+                        help='Size of each file of the huge-files run in MB (default is 256)')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Milliseconds added to every HTTP request and FTP command (default is 20)')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Limit of each FTP data connection in MB/s, 0 for none (default is 0)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of times each scenario is run, the fastest run is reported (default is 1)')
+    parser.add_argument('--tool-args', default='',
+                        help='Extra arguments passed to enaDataGet/enaGroupGet, e.g. "-p 4 --asyncio"')
+    parser.add_argument('-o', '--output', default=None, help='Save the results to this JSON file')
+    parser.add_argument('-b', '--baseline', default=None,
+                        help='Compare wall times with the results saved in this JSON file')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory for the synthetic dataset and downloads (default is a temporary directory)')
+    return parser
+
+
+def main():
+    parser = set_parser()
+    args = parser.parse_args()
+    scenarios = args.scenarios if args.scenarios else sorted(SCENARIOS)
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error('invalid scenario: {0} (choose from {1})'.format(scenario, ', '.join(sorted(SCENARIOS))))
+    work_dir = tempfile.mkdtemp(prefix='ena_benchmark_', dir=args.work_dir)
+    try:
+        print('Generating synthetic dataset in ' + work_dir)
+        dataset = Dataset(os.path.join(work_dir, 'ftp'), args)
+        view_server, ftp_server = start_stand_ins(dataset, args)
+        view_server.base_url = 'http://127.0.0.1:{0}/'.format(view_server.server_address[1])
+        baselines = {}
+        if args.baseline is not None:
+            with open(args.baseline) as f:
+                baselines = dict((r['scenario'], r) for r in json.load(f))
+        results = []
+        for scenario in scenarios:
+            print('Running ' + scenario)
+            runs = [run_scenario(scenario, work_dir, view_server, ftp_server, args.tool_args.split())
+                    for i in range(args.repeat)]
+            results.append(min(runs, key=lambda r: (r['exit_code'] != 0, r['wall_time'])))
+        print_results(results, baselines)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if any(r['exit_code'] != 0 for r in results):
+            sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    if CHILD_ENV in os.environ:
+        run_tool(sys.argv[1:])
+    else:
+        main()
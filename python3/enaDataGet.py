@@ -18,26 +18,34 @@
 #
 
 import argparse
+import os
 import sys
 
 import sequenceGet
 import assemblyGet
 import readGet
+import transferManifest
+import transferPlan
 import utils
 import traceback
 
+# accession types an accession list may hold, in the order they are downloaded
+LIST_ACCESSION_TYPES = [utils.SEQUENCE, utils.WGS, utils.ASSEMBLY, utils.RUN, utils.EXPERIMENT, utils.SAMPLE,
+                        utils.ANALYSIS]
+READ_ACCESSION_TYPES = [utils.RUN, utils.EXPERIMENT, utils.SAMPLE, utils.ANALYSIS]
+
 
 def set_parser():
     parser = argparse.ArgumentParser(prog='enaDataGet',
                                      description='Download data for a given accession')
-    parser.add_argument('accession', help="""Sequence, coding, assembly, run, experiment or
+    parser.add_argument('accession', nargs='?', help="""Sequence, coding, assembly, run, experiment or
                                         analysis accession or WGS prefix (LLLLVV) to download """)
     parser.add_argument('-f', '--format', default=None,
                         choices=['embl', 'fasta', 'submitted', 'fastq', 'sra'],
                         help="""File format required. Format requested must be permitted for
                               data type selected. sequence, assembly and wgs accessions: embl(default) and fasta formats.
                               read group: submitted, fastq and sra formats. analysis group: submitted only.""")
-    parser.add_argument('-d', '--dest', default='.',
+    parser.add_argument('-d', '--dest', default=None,
                         help='Destination directory (default is current running directory)')
     parser.add_argument('-w', '--wgs', action='store_true',
                         help='Download WGS set for each assembly if available (default is false)')
@@ -52,64 +60,275 @@ def set_parser():
     parser.add_argument('-as', '--aspera-settings', default=None,
                         help="""Use the provided settings file, will otherwise check
                         for environment variable or default settings file location.""")
+    parser.add_argument('-p', '--parallel', type=int, default=1,
+                        help='Number of read or analysis files to download concurrently (default is 1)')
+    parser.add_argument('-pa', '--parallel-accessions', type=int, default=1,
+                        help="""Number of accessions of an --accession-file list to process concurrently
+                        (default is 1). The --parallel limit on files downloading at once applies
+                        across all of them.""")
+    parser.add_argument('-ix', '--index-wgs', action='store_true',
+                        help='Build a random-access index for each downloaded WGS set file (default is false)')
+    parser.add_argument('--rehash', action='store_true',
+                        help="""Recompute the MD5 of files already in the destination directory instead
+                        of trusting the checksum manifest kept there (default is false)""")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="""Use the asyncio transfer backend for sequence record fetches and group
+                        portal queries; requires aiohttp (default is false)""")
+    parser.add_argument('--async-concurrency', type=int, default=10,
+                        help='Number of requests in flight at once with --asyncio (default is 10)')
+    parser.add_argument('-sg', '--segments', type=int, default=1,
+                        help="""Number of connections used to download each file larger than the segment
+                        threshold, in byte ranges (default is 1)""")
+    parser.add_argument('--segment-threshold', type=int, default=256,
+                        help='Size in MB from which files are downloaded in segments (default is 256)')
+    parser.add_argument('--cache', action='store_true',
+                        help="""Reuse portal and XML responses cached by earlier runs, which may miss data
+                        added to ENA since (default is false)""")
+    parser.add_argument('--cache-dir', default=None,
+                        help="""Directory to keep FTP listings and, with --cache, portal and XML responses in
+                        (default is ~/.cache/enaBrowserTools)""")
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help="""Number of attempts at each file transfer or ENA query before giving up,
+                        retrying only errors that may be transient (default is 3)""")
+    parser.add_argument('--retry-backoff', type=float, default=1,
+                        help="""Seconds to wait before the first retry, doubled for each further retry
+                        and randomised (default is 1)""")
+    parser.add_argument('--circuit-breaker', type=int, default=5,
+                        help="""Number of consecutive failures after which a host is not contacted for
+                        30 seconds, 0 to disable (default is 5)""")
+    parser.add_argument('--order', default='largest-first', choices=transferPlan.ORDERS,
+                        help="""Order read and analysis files are downloaded in: largest-first, interleaved
+                        (largest and smallest alternating) or listed (as returned by ENA)
+                        (default is largest-first)""")
+    parser.add_argument('--manifest-only', default=None, metavar='MANIFEST_FILE',
+                        help="""Write the read or analysis files that would be downloaded to this file,
+                        with their target path, FTP, HTTPS and Aspera URLs, MD5 and size, instead
+                        of downloading them""")
+    parser.add_argument('--manifest-format', default='tsv', choices=transferManifest.FORMATS,
+                        help='Format of the file written with --manifest-only (default is tsv)')
+    parser.add_argument('--accession-file', default=None,
+                        help="""Download every accession listed in this file, one per line, or read from
+                        standard input if '-', in this one run instead of the accession argument.
+                        Repeated accessions are downloaded once""")
+    parser.add_argument('--report', default=None,
+                        help="""File to write the type and download status of each accession of an
+                        --accession-file list to (default is accession_report.tsv in the destination
+                        directory)""")
+    parser.add_argument('--from-manifest', default=None, metavar='MANIFEST_FILE',
+                        help="""Download the files listed in a manifest written with --manifest-only,
+                        in TSV or JSON, to the paths it gives, instead of those of an accession.
+                        Relative paths are taken from the current directory""")
+    parser.add_argument('--metrics-file', default=None,
+                        help='Append a JSON line describing each file transfer and record fetch to this file')
+    parser.add_argument('--prometheus-file', default=None,
+                        help="""Write transfer totals to this file in the Prometheus text format when
+                        the run ends, e.g. for the node exporter textfile collector""")
     parser.add_argument('-v', '--version', action='version', version='%(prog)s 1.7.2')
     return parser
 
 
-def check_availability(accession, output_format):
-    if not utils.is_available(accession, output_format):
+def check_availability(accession, output_format, expanded=False, keep=False):
+    if not utils.is_available(accession, output_format, expanded, keep):
         sys.stderr.write(
             'ERROR: Record does not exist or is not available for accession provided\n')
         sys.exit(1)
 
 
+def is_read_accession(accession):
+    return utils.is_analysis(accession) or utils.is_run(accession) or utils.is_experiment(accession) \
+        or utils.is_sample(accession)
+
+
+def download_accession(accession, output_format, dest_dir, fetch_wgs, extract_wgs, expanded, fetch_meta, aspera,
+                       check=True, file_results=None):
+    # check is False for accession lists, where a missing record fails its own download instead.
+    # file_results are the file search rows of a read or analysis accession, if already fetched
+    if utils.is_wgs_set(accession):
+        if output_format is not None:
+            sequenceGet.check_format(output_format)
+        else:
+            output_format = sequenceGet.get_default_format()
+        if check:
+            check_availability(accession, output_format)
+        if sequenceGet.download_wgs(dest_dir, accession, output_format) is None:
+            return utils.FAILED
+        return utils.DOWNLOADED
+    elif utils.is_assembly(accession):
+        if output_format is not None:
+            assemblyGet.check_format(output_format)
+        else:
+            output_format = assemblyGet.get_default_format()
+        if check:
+            check_availability(accession, output_format, keep=True)
+        assemblyGet.download_assembly(dest_dir, accession, output_format, fetch_wgs, extract_wgs, expanded)
+        return utils.DOWNLOADED
+    elif utils.is_sequence(accession):
+        if output_format is not None:
+            sequenceGet.check_format(output_format)
+        else:
+            output_format = sequenceGet.get_default_format()
+        if check:
+            check_availability(accession, output_format, expanded, True)
+        if not sequenceGet.download_sequence(dest_dir, accession, output_format, expanded):
+            return utils.FAILED
+        return utils.DOWNLOADED
+    elif is_read_accession(accession):
+        if output_format is not None:
+            readGet.check_read_format(output_format)
+        if check:
+            # the XML checked is saved with -m, except for a sample, whose runs are saved instead
+            check_availability(accession, output_format, keep=fetch_meta and not utils.is_sample(accession))
+        statuses = readGet.download_files(accession, output_format, dest_dir, fetch_meta, aspera, file_results)
+        # nothing to download is only a failure when the accession was not checked to exist
+        if len(statuses) == 0 and not check:
+            return utils.FAILED
+        return utils.get_overall_status(statuses)
+    sys.stderr.write('ERROR: Invalid accession provided\n')
+    sys.exit(1)
+
+
+def read_accession_file(accession_file):
+    # the first word of each line, '-' reading standard input; blank lines, # comments and repeats are skipped
+    f = sys.stdin if accession_file == '-' else open(accession_file)
+    accessions = []
+    seen = set()
+    try:
+        for line in f:
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#') or words[0] in seen:
+                continue
+            seen.add(words[0])
+            accessions.append(words[0])
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return accessions
+
+
+def get_list_accession_type(accession):
+    accession_type = utils.get_accession_type(accession)
+    if accession_type is None and utils.is_sample(accession):
+        return utils.SAMPLE
+    return accession_type
+
+
+def get_list_format(accession_type, output_format):
+    # the format of a list applies to the accessions it is allowed for, the rest get their default one
+    if accession_type in [utils.RUN, utils.EXPERIMENT, utils.SAMPLE]:
+        allowed_formats = [utils.SUBMITTED_FORMAT, utils.FASTQ_FORMAT, utils.SRA_FORMAT]
+    elif accession_type == utils.ANALYSIS:
+        allowed_formats = [utils.SUBMITTED_FORMAT]
+    elif accession_type == utils.ASSEMBLY:
+        allowed_formats = [utils.EMBL_FORMAT, utils.FASTA_FORMAT]
+    else:
+        allowed_formats = [utils.EMBL_FORMAT, utils.FASTA_FORMAT, utils.MASTER_FORMAT]
+    return output_format if output_format in allowed_formats else None
+
+
+def attempt_accession_download(accession, accession_type, output_format, dest_dir, fetch_wgs, extract_wgs, expanded,
+                               fetch_meta, aspera, file_results):
+    # an error is confined to the accession it occurred in, the rest of the list carries on
+    try:
+        status = download_accession(accession, output_format, dest_dir, fetch_wgs, extract_wgs, expanded, fetch_meta,
+                                    aspera, False, file_results)
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        print('Failed to fetch ' + accession)
+        status = utils.FAILED
+    return accession, accession_type, status
+
+
+def write_accession_report(report_file, results):
+    with open(report_file, 'w') as f:
+        f.write('accession\ttype\tstatus\n')
+        for accession, accession_type, status in results:
+            f.write('{0}\t{1}\t{2}\n'.format(accession, accession_type, status))
+
+
+def download_accession_list(accessions, output_format, dest_dir, fetch_wgs, extract_wgs, expanded, fetch_meta, aspera,
+                            report_file):
+    # all accessions of a list in this one process, a type at a time, up to utils.PARALLEL_ACCESSIONS at once
+    accessions_by_type = {}
+    for accession in accessions:
+        accessions_by_type.setdefault(get_list_accession_type(accession), []).append(accession)
+    results = []
+    for accession_type in [t for t in accessions_by_type if t not in LIST_ACCESSION_TYPES]:
+        for accession in accessions_by_type[accession_type]:
+            print('Invalid accession: ' + accession)
+            results.append((accession, accession_type or 'unknown', utils.FAILED))
+    # the files of all read and analysis accessions are looked up in a few batched portal searches
+    file_results = utils.get_file_search_results([accession for accession_type in READ_ACCESSION_TYPES
+                                                  for accession in accessions_by_type.get(accession_type, [])], aspera)
+    for accession_type in LIST_ACCESSION_TYPES:
+        type_accessions = accessions_by_type.get(accession_type, [])
+        if len(type_accessions) == 0:
+            continue
+        print('Fetching {0} {1} accessions'.format(len(type_accessions), accession_type))
+        list_format = get_list_format(accession_type, output_format)
+        downloads = [(accession, accession_type, list_format, dest_dir, fetch_wgs, extract_wgs, expanded, fetch_meta,
+                      aspera, file_results.get(accession)) for accession in type_accessions]
+        results.extend(utils.run_in_order(attempt_accession_download, downloads, utils.PARALLEL_ACCESSIONS))
+    write_accession_report(report_file, results)
+    print('Wrote the status of each accession to ' + report_file)
+    utils.print_status_summary([status for accession, accession_type, status in results])
+    return results
+
+
 if __name__ == '__main__':
     parser = set_parser()
     args = parser.parse_args()
+    if [args.accession, args.accession_file, args.from_manifest].count(None) != 2:
+        parser.error('one of an accession, --accession-file or --from-manifest is required')
+    if args.manifest_only is not None and args.accession is None:
+        parser.error('--manifest-only needs an accession')
+    if args.from_manifest is not None and args.dest is not None:
+        parser.error('-d cannot be used with --from-manifest, which downloads to the paths the manifest lists')
 
-    accession = args.accession.strip()
+    accession = args.accession.strip() if args.accession is not None else None
     output_format = args.format
-    dest_dir = args.dest
+    dest_dir = args.dest if args.dest is not None else '.'
     fetch_wgs = args.wgs
     extract_wgs = args.extract_wgs
     expanded = args.expanded
     fetch_meta = args.meta
     aspera = args.aspera
     aspera_settings = args.aspera_settings
+    utils.set_parallel_transfers(args.parallel)
+    utils.set_parallel_accessions(args.parallel_accessions)
+    utils.set_rehash(args.rehash)
+    utils.set_index_wgs(args.index_wgs)
+    utils.set_async_transfers(args.asyncio, args.async_concurrency)
+    utils.set_segments(args.segments, args.segment_threshold)
+    utils.set_cache(args.cache_dir, args.cache)
+    utils.set_retry_policy(args.max_attempts, args.retry_backoff, args.circuit_breaker)
+    utils.set_transfer_order(args.order)
+    utils.set_metrics(args.metrics_file, args.prometheus_file)
 
     if aspera or aspera_settings is not None:
         aspera = utils.set_aspera(aspera_settings)
 
     try:
-        if utils.is_wgs_set(accession):
-            if output_format is not None:
-                sequenceGet.check_format(output_format)
-            else:
-                output_format = sequenceGet.get_default_format()
-            check_availability(accession, output_format)
-            sequenceGet.download_wgs(dest_dir, accession, output_format)
-        elif utils.is_assembly(accession):
-            if output_format is not None:
-                assemblyGet.check_format(output_format)
-            else:
-                output_format = assemblyGet.get_default_format()
-            check_availability(accession, output_format)
-            assemblyGet.download_assembly(dest_dir, accession, output_format, fetch_wgs, extract_wgs, expanded)
-        elif utils.is_sequence(accession):
-            if output_format is not None:
-                sequenceGet.check_format(output_format)
-            else:
-                output_format = sequenceGet.get_default_format()
-            check_availability(accession, output_format)
-            sequenceGet.download_sequence(dest_dir, accession, output_format, expanded)
-        elif utils.is_analysis(accession) or utils.is_run(accession) or utils.is_experiment(accession) or utils.is_sample(accession):
+        if args.from_manifest is not None:
+            readGet.download_manifest(args.from_manifest, aspera)
+        elif args.accession_file is not None:
+            report_file = args.report if args.report is not None else os.path.join(dest_dir, 'accession_report.tsv')
+            utils.create_dir(dest_dir)
+            download_accession_list(read_accession_file(args.accession_file), output_format, dest_dir, fetch_wgs,
+                                    extract_wgs, expanded, fetch_meta, aspera, report_file)
+        elif args.manifest_only is not None:
+            if not is_read_accession(accession):
+                sys.stderr.write('ERROR: Manifests are only available for run, experiment, sample and '
+                                 'analysis accessions\n')
+                sys.exit(1)
             if output_format is not None:
                 readGet.check_read_format(output_format)
             check_availability(accession, output_format)
-            readGet.download_files(accession, output_format, dest_dir, fetch_meta, aspera)
+            transferManifest.write_manifest(readGet.get_manifest_rows(accession, output_format, dest_dir),
+                                            args.manifest_only, args.manifest_format)
         else:
-            sys.stderr.write('ERROR: Invalid accession provided\n')
-            sys.exit(1)
+            download_accession(accession, output_format, dest_dir, fetch_wgs, extract_wgs, expanded, fetch_meta,
+                               aspera)
+        utils.print_cache_summary()
         print('Completed')
     except Exception:
         traceback.print_exc()
@@ -24,14 +24,18 @@ import sys
 import sequenceGet
 import assemblyGet
 import readGet
+import transferManifest
+import transferPlan
 import utils
 import traceback
 import time
 
+SEQUENCE_PROGRESS_INTERVAL = 10000  # report progress every this many sequences
+
 
 def set_parser():
     parser = argparse.ArgumentParser(prog='enaGroupGet',
-                                     description='Download data for a given study or sample, or (for sequence and assembly) taxon')
+                                     description='Download data for a given study, sample or taxon')
     parser.add_argument('accession', help='Study or sample accession or NCBI tax ID to fetch data for')
     parser.add_argument('-g', '--group', default='read',
                         choices=['sequence', 'wgs', 'assembly', 'read', 'analysis'],
@@ -58,12 +62,70 @@ def set_parser():
                         for environment variable or default settings file location.""")
     parser.add_argument('-t', '--subtree', action='store_true',
                         help='Include subordinate taxa (taxon subtree) when querying with NCBI tax ID (default is false)')
+    parser.add_argument('-p', '--parallel', type=int, default=1,
+                        help='Number of read or analysis files to download concurrently (default is 1)')
+    parser.add_argument('-pa', '--parallel-accessions', type=int, default=1,
+                        help="""Number of runs, analyses, assemblies or WGS sets of the group to process
+                        concurrently (default is 1). The --parallel limit on files downloading at once
+                        applies across all of them.""")
+    parser.add_argument('-ix', '--index-wgs', action='store_true',
+                        help='Build a random-access index for each downloaded WGS set file (default is false)')
+    parser.add_argument('--rehash', action='store_true',
+                        help="""Recompute the MD5 of files already in the destination directory instead
+                        of trusting the checksum manifest kept there (default is false)""")
+    parser.add_argument('--asyncio', action='store_true',
+                        help="""Use the asyncio transfer backend for sequence record fetches and group
+                        portal queries; requires aiohttp (default is false)""")
+    parser.add_argument('--async-concurrency', type=int, default=10,
+                        help='Number of requests in flight at once with --asyncio (default is 10)')
+    parser.add_argument('-sg', '--segments', type=int, default=1,
+                        help="""Number of connections used to download each file larger than the segment
+                        threshold, in byte ranges (default is 1)""")
+    parser.add_argument('--segment-threshold', type=int, default=256,
+                        help='Size in MB from which files are downloaded in segments (default is 256)')
+    parser.add_argument('--cache', action='store_true',
+                        help="""Reuse portal and XML responses cached by earlier runs, which may miss data
+                        added to ENA since (default is false)""")
+    parser.add_argument('--cache-dir', default=None,
+                        help="""Directory to keep FTP listings and, with --cache, portal and XML responses in
+                        (default is ~/.cache/enaBrowserTools)""")
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help="""Number of attempts at each file transfer or ENA query before giving up,
+                        retrying only errors that may be transient (default is 3)""")
+    parser.add_argument('--retry-backoff', type=float, default=1,
+                        help="""Seconds to wait before the first retry, doubled for each further retry
+                        and randomised (default is 1)""")
+    parser.add_argument('--circuit-breaker', type=int, default=5,
+                        help="""Number of consecutive failures after which a host is not contacted for
+                        30 seconds, 0 to disable (default is 5)""")
+    parser.add_argument('--order', default='largest-first', choices=transferPlan.ORDERS,
+                        help="""Order read and analysis files, and the runs or analyses of the group, are
+                        downloaded in: largest-first, interleaved (largest and smallest alternating) or
+                        listed (as returned by ENA) (default is largest-first)""")
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help="""Download the read or analysis group of an NCBI tax ID without asking to
+                        confirm its total size first (default is false)""")
+    parser.add_argument('--manifest-only', default=None, metavar='MANIFEST_FILE',
+                        help="""Write the files of a read or analysis group that would be downloaded to
+                        this file, with their target path, FTP, HTTPS and Aspera URLs, MD5 and size,
+                        instead of downloading them""")
+    parser.add_argument('--manifest-format', default='tsv', choices=transferManifest.FORMATS,
+                        help='Format of the file written with --manifest-only (default is tsv)')
+    parser.add_argument('--metrics-file', default=None,
+                        help='Append a JSON line describing each file transfer and record fetch to this file')
+    parser.add_argument('--prometheus-file', default=None,
+                        help="""Write transfer totals to this file in the Prometheus text format when
+                        the run ends, e.g. for the node exporter textfile collector""")
     parser.add_argument('-v', '--version', action='version', version='%(prog)s 1.7.2')
     return parser
 
 
 def download_report(group, result, accession, temp_file, subtree):
     search_url = utils.get_group_search_query(group, result, accession, subtree)
+    download_report_file(search_url, temp_file)
+
+
+def download_report_file(search_url, temp_file):
     response = utils.get_report_from_portal(search_url)
     f = open(temp_file, 'wb')
     for line in response:
@@ -72,83 +134,176 @@ def download_report(group, result, accession, temp_file, subtree):
     f.close()
 
 
-def download_data(group, data_accession, output_format, group_dir, fetch_wgs, extract_wgs, expanded, fetch_meta, aspera):
+def download_data(group, data_accession, output_format, group_dir, fetch_wgs, extract_wgs, expanded, fetch_meta, aspera,
+                  file_results=None):
     if group == utils.WGS:
         print('Fetching ' + data_accession[:6])
-        sequenceGet.download_wgs(group_dir, data_accession[:6], output_format)
+        if sequenceGet.download_wgs(group_dir, data_accession[:6], output_format) is None:
+            return utils.FAILED
+        return utils.DOWNLOADED
     else:
         print('Fetching ' + data_accession)
         if group == utils.ASSEMBLY:
             assemblyGet.download_assembly(group_dir, data_accession, output_format, fetch_wgs, extract_wgs, expanded,
                                           True)
+            return utils.DOWNLOADED
         elif group in [utils.READ, utils.ANALYSIS]:
-            readGet.download_files(data_accession, output_format, group_dir, fetch_meta, aspera)
+            statuses = readGet.download_files(data_accession, output_format, group_dir, fetch_meta, aspera,
+                                              file_results)
+            return utils.get_overall_status(statuses)
+    return utils.SKIPPED
+
+
+def attempt_data_download(group, data_accession, output_format, group_dir, fetch_wgs, extract_wgs, expanded, fetch_meta,
+                          aspera, file_results=None):
+    # an error is confined to the accession it occurred in, the rest of the group carries on
+    try:
+        status = download_data(group, data_accession, output_format, group_dir, fetch_wgs, extract_wgs, expanded,
+                               fetch_meta, aspera, file_results)
+    except (Exception, SystemExit):
+        traceback.print_exc()
+        print('Failed to fetch ' + data_accession)
+        status = utils.FAILED
+    return data_accession, status
+
+
+def plan_data_group(group, accession, output_format, group_dir, aspera, subtree, assume_yes):
+    # the file search rows of the runs or analyses of the group, once the user has agreed to a
+    # taxon's total. They are passed on to readGet, which then needs no search of its own per run
+    group_results = utils.get_group_file_search_results(group, accession, subtree, aspera)
+    group_files = transferPlan.get_group_files(group_results, output_format, aspera)
+    total_size = transferPlan.plan_group(group_files, group_dir)
+    # a tax ID can match far more data than intended, so its size is confirmed before anything is fetched
+    if utils.is_taxid(accession) and not assume_yes:
+        if not transferPlan.confirm('Download {0} for tax ID {1}?'.format(transferPlan.format_size(total_size),
+                                                                          accession)):
+            print('Not downloading; use --yes to download the {0} group of a tax ID without asking'.format(group))
+            sys.exit(1)
+    file_cnt = sum(len(data_files) for data_files in group_files.values())
+    if file_cnt > 0:
+        transferPlan.start_progress(total_size, file_cnt)
+    return group_results, group_files
 
 
 def download_data_group(group, accession, output_format, group_dir, fetch_wgs, extract_wgs, fetch_meta, aspera,
-                        subtree, expanded):
+                        subtree, expanded, assume_yes):
     temp_file_path = os.path.join(group_dir, accession + '_temp.txt')
     download_report(group, utils.get_group_result(group), accession, temp_file_path, subtree)
     header = True
+    downloads = []
     with open(temp_file_path) as f:
         for line in f:
             if header:
                 header = False
                 continue
             data_accession = line.strip()
-            download_data(group, data_accession, output_format, group_dir, fetch_wgs, extract_wgs, expanded, fetch_meta,
-                          aspera)
+            downloads.append((group, data_accession, output_format, group_dir, fetch_wgs, extract_wgs, expanded,
+                              fetch_meta, aspera))
     os.remove(temp_file_path)
+    if group in [utils.READ, utils.ANALYSIS]:
+        group_results, group_files = plan_data_group(group, accession, output_format, group_dir, aspera, subtree,
+                                                     assume_yes)
+        downloads = [download + (group_results.get(download[1]),) for download in downloads]
+        downloads = transferPlan.order_by_size(
+            downloads, lambda download: transferPlan.get_group_size(group_files, download[1]), utils.TRANSFER_ORDER)
+    results = utils.run_in_order(attempt_data_download, downloads, utils.PARALLEL_ACCESSIONS)
+    utils.print_status_table(results)
+    return results
 
 
-def download_sequence_result(dest_file, group_dir, result, accession, subtree, update_accs, expanded):
-    ts = time.time()
-    temp_file_path = os.path.join(group_dir, str(ts) + 'temp.txt')
-    download_report(utils.SEQUENCE, result, accession, temp_file_path, subtree)
+def write_group_manifest(group, accession, output_format, dest_dir, subtree, manifest_file, manifest_format):
+    # the files download_data_group would fetch, from a single portal query, without fetching them
+    group_dir = os.path.join(dest_dir, accession)
+    search_url = utils.get_group_manifest_search_query(group, accession, subtree)
+    result_accession = 'analysis_accession' if group == utils.ANALYSIS else 'run_accession'
+    rows = []
+    for item in utils.download_report_from_portal(search_url):
+        rows.extend(transferManifest.get_rows(item, item[result_accession], output_format,
+                                              lambda data_accession: os.path.join(group_dir, data_accession)))
+    transferManifest.write_manifest(rows, manifest_file, manifest_format)
+
+
+def read_report_accessions(report_file_path):
     header = True
-    with open(temp_file_path) as f:
+    with open(report_file_path) as f:
         for line in f:
             if header:
                 header = False
                 continue
             data_accession = line.strip()
-            write_record = False
-            if result == utils.SEQUENCE_UPDATE_RESULT:
-                update_accs.append(data_accession)
-                write_record = True
-            elif result == utils.SEQUENCE_RELEASE_RESULT:
-                if data_accession not in update_accs:
-                    write_record = True
-            if write_record:
-                sequenceGet.write_record(dest_file, data_accession, output_format)
-                dest_file.flush()
-    os.remove(temp_file_path)
-    return update_accs
+            if data_accession != '':
+                yield data_accession
+
+
+def get_new_accessions(data_accessions, seen_accs):
+    # sequences found in sequence_update are not fetched again from sequence_release
+    for data_accession in data_accessions:
+        if data_accession not in seen_accs:
+            seen_accs.add(data_accession)
+            yield data_accession
+
+
+def print_sequence_progress(count, start_time):
+    elapsed = time.time() - start_time
+    rate = count / elapsed if elapsed > 0 else 0
+    print('downloaded {0} sequences ({1:.0f} records/s)'.format(count, rate))
+
+
+def download_sequence_result(dest_file, report_file_path, output_format, seen_accs, expanded, progress):
+    def print_progress(batch, failed_batch):
+        previous_count = progress['count']
+        progress['count'] += len(batch) - len(failed_batch)
+        if progress['count'] // SEQUENCE_PROGRESS_INTERVAL > previous_count // SEQUENCE_PROGRESS_INTERVAL:
+            print_sequence_progress(progress['count'], progress['start_time'])
+
+    new_accessions = get_new_accessions(read_report_accessions(report_file_path), seen_accs)
+    failed_accessions = sequenceGet.write_record_batches(dest_file, new_accessions, output_format, expanded,
+                                                         print_progress)
+    os.remove(report_file_path)
+    return failed_accessions
+
+
+def download_sequence_reports(group_dir, accession, subtree):
+    ts = time.time()
+    reports = []
+    for result in [utils.SEQUENCE_UPDATE_RESULT, utils.SEQUENCE_RELEASE_RESULT]:
+        search_url = utils.get_group_search_query(utils.SEQUENCE, result, accession, subtree)
+        reports.append((search_url, os.path.join(group_dir, str(ts) + result.split('=')[-1] + '_temp.txt')))
+    if utils.ASYNC_TRANSFERS:
+        import asyncUtils
+        asyncUtils.download_reports(reports)
+    else:
+        for search_url, temp_file_path in reports:
+            download_report_file(search_url, temp_file_path)
+    return [temp_file_path for search_url, temp_file_path in reports]
 
 
 def download_sequence_group(accession, output_format, group_dir, subtree, expanded):
     print('Downloading sequences')
-    update_accs = []
+    seen_accs = set()
+    progress = {'count': 0, 'start_time': time.time()}
     dest_file_path = os.path.join(group_dir, utils.get_filename(accession + '_sequences', output_format))
-    dest_file = open(dest_file_path, 'wb')
-    # sequence update
-    update_accs = download_sequence_result(dest_file, group_dir, utils.SEQUENCE_UPDATE_RESULT, accession, subtree,
-                                           update_accs, expanded)
-    # sequence release
-    update_accs = download_sequence_result(dest_file, group_dir, utils.SEQUENCE_RELEASE_RESULT, accession, subtree,
-                                           update_accs, expanded)
-    dest_file.close()
+    report_file_paths = download_sequence_reports(group_dir, accession, subtree)
+    failed_accessions = []
+    with open(dest_file_path, 'wb') as dest_file:
+        for report_file_path in report_file_paths:
+            failed_accessions.extend(download_sequence_result(dest_file, report_file_path, output_format, seen_accs,
+                                                              expanded, progress))
+    print_sequence_progress(progress['count'], progress['start_time'])
+    if len(failed_accessions) > 0:
+        print('Failed to fetch following sequences, format {0}'.format(output_format))
+        print(','.join(failed_accessions))
 
 
 def download_group(accession, group, output_format, dest_dir, fetch_wgs, extract_wgs, fetch_meta, aspera,
-                   subtree, expanded):
+                   subtree, expanded, assume_yes=False):
     group_dir = os.path.join(dest_dir, accession)
     utils.create_dir(group_dir)
     if group == utils.SEQUENCE:
         download_sequence_group(accession, output_format, group_dir, subtree, expanded)
     else:
         download_data_group(group, accession, output_format, group_dir, fetch_wgs, extract_wgs, fetch_meta, aspera,
-                            subtree, expanded)
+                            subtree, expanded, assume_yes)
 
 
 if __name__ == '__main__':
@@ -165,6 +320,16 @@ if __name__ == '__main__':
     fetch_meta = args.meta
     aspera = args.aspera
     aspera_settings = args.aspera_settings
+    utils.set_parallel_transfers(args.parallel)
+    utils.set_parallel_accessions(args.parallel_accessions)
+    utils.set_rehash(args.rehash)
+    utils.set_index_wgs(args.index_wgs)
+    utils.set_async_transfers(args.asyncio, args.async_concurrency)
+    utils.set_segments(args.segments, args.segment_threshold)
+    utils.set_cache(args.cache_dir, args.cache)
+    utils.set_retry_policy(args.max_attempts, args.retry_backoff, args.circuit_breaker)
+    utils.set_transfer_order(args.order)
+    utils.set_metrics(args.metrics_file, args.prometheus_file)
     subtree = args.subtree
 
     if aspera or aspera_settings is not None:
@@ -193,12 +358,16 @@ if __name__ == '__main__':
         sys.exit(1)
 
     try:
-        # disable read and analysis retrieval for taxon until added in size calculation and user response
-        if utils.is_taxid(accession) and group in ['read', 'analysis']:
-            print('Sorry, tax ID retrieval not yet supported for read and analysis')
-            sys.exit(1)
-        download_group(accession, group, output_format, dest_dir, fetch_wgs, extract_wgs, fetch_meta, aspera, subtree,
-                       expanded)
+        if args.manifest_only is not None:
+            if group not in [utils.READ, utils.ANALYSIS]:
+                sys.stderr.write('ERROR: Manifests are only available for the read and analysis groups\n')
+                sys.exit(1)
+            write_group_manifest(group, accession, output_format, dest_dir, subtree, args.manifest_only,
+                                 args.manifest_format)
+        else:
+            download_group(accession, group, output_format, dest_dir, fetch_wgs, extract_wgs, fetch_meta, aspera,
+                           subtree, expanded, args.yes)
+        utils.print_cache_summary()
         print('Completed')
     except Exception:
         traceback.print_exc()
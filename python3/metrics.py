@@ -0,0 +1,120 @@
+#
+# metrics.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Structured metrics for every file transfer and record fetch. Each transfer is
+# written as one JSON object per line to the metrics file as soon as it ends,
+# and totals per protocol and outcome can be written as a snapshot in the
+# Prometheus text format, for the node exporter textfile collector.
+
+import json
+import os
+import threading
+import time
+
+SUCCESS = 'success'
+FAILED = 'failed'
+MD5_MISMATCH = 'md5_mismatch'
+
+
+def get_outcome(event):
+    if event.get('md5') == 'mismatch':
+        return MD5_MISMATCH
+    if event.get('error') is not None:
+        return FAILED
+    return SUCCESS
+
+
+def format_labels(labels):
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in labels) + '}'
+
+
+class MetricsWriter(object):
+
+    def __init__(self, metrics_file, prometheus_file):
+        self.prometheus_file = prometheus_file
+        self.lock = threading.Lock()
+        self.file = open(metrics_file, 'a') if metrics_file is not None else None
+        self.totals = {}  # (protocol, outcome) -> [transfers, bytes, seconds, retries]
+        self.retries = {}  # (protocol, error class) -> retries
+        self.circuit_trips = {}  # host -> times the circuit breaker opened
+
+    def record(self, event):
+        event = dict(event, time=round(time.time(), 3))
+        line = json.dumps(event, sort_keys=True) + '\n'
+        key = (event['protocol'], get_outcome(event))
+        with self.lock:
+            if self.file is not None:
+                # one write per event, flushed at once, so lines from concurrent transfers never interleave
+                self.file.write(line)
+                self.file.flush()
+            totals = self.totals.setdefault(key, [0, 0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += event['bytes']
+            totals[2] += event['duration']
+            totals[3] += 1 if event['retries'] > 0 else 0
+
+    def record_retry(self, protocol, error):
+        with self.lock:
+            self.retries[(protocol, error)] = self.retries.get((protocol, error), 0) + 1
+
+    def record_circuit_trip(self, host):
+        with self.lock:
+            self.circuit_trips[host] = self.circuit_trips.get(host, 0) + 1
+
+    def write_prometheus(self):
+        lines = []
+        metrics = [('ena_transfers_total', 'Number of transfers', 0),
+                   ('ena_transfer_bytes_total', 'Bytes transferred', 1),
+                   ('ena_transfer_duration_seconds_total', 'Time spent transferring', 2),
+                   ('ena_transfer_retries_total', 'Number of transfers that were retries', 3)]
+        with self.lock:
+            totals = sorted(self.totals.items())
+            retries = sorted(self.retries.items())
+            circuit_trips = sorted(self.circuit_trips.items())
+        for name, description, index in metrics:
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} counter'.format(name))
+            for (protocol, outcome), values in totals:
+                lines.append('{0}{1} {2}'.format(
+                    name, format_labels([('protocol', protocol), ('outcome', outcome)]), values[index]))
+        lines.append('# HELP ena_retries_total Number of retries of transfers and queries, by the error retried')
+        lines.append('# TYPE ena_retries_total counter')
+        for (protocol, error), count in retries:
+            lines.append('ena_retries_total{0} {1}'.format(
+                format_labels([('protocol', protocol), ('error', error)]), count))
+        lines.append('# HELP ena_circuit_breaker_trips_total Number of times a host was left alone after failing')
+        lines.append('# TYPE ena_circuit_breaker_trips_total counter')
+        for host, count in circuit_trips:
+            lines.append('ena_circuit_breaker_trips_total{0} {1}'.format(format_labels([('host', host)]), count))
+        lines.append('# HELP ena_metrics_timestamp_seconds Time the snapshot was written')
+        lines.append('# TYPE ena_metrics_timestamp_seconds gauge')
+        lines.append('ena_metrics_timestamp_seconds {0:.3f}'.format(time.time()))
+        # written next to the target and renamed, so the collector never reads half a snapshot
+        temp_file = self.prometheus_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, self.prometheus_file)
+
+    def close(self):
+        if self.prometheus_file is not None:
+            self.write_prometheus()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -19,8 +19,11 @@
 
 import os
 import sys
+import time
 import urllib.parse as urlparse
 
+import transferManifest
+import transferPlan
 import utils
 
 
@@ -41,29 +44,83 @@ def check_analysis_format(output_format):
         sys.exit(1)
 
 
-def attempt_file_download(file_url, dest_dir, md5, aspera):
+def attempt_file_download(file_url, dest_dir, md5, aspera, accession, retries):
     if md5 is not None:
         print('Downloading file with md5 check:' + file_url)
         if aspera:
-            return utils.get_aspera_file_with_md5_check(file_url, dest_dir, md5)
+            return utils.get_aspera_file_with_md5_check(file_url, dest_dir, md5, accession, retries)
         else:
             file_url = urlparse.quote(file_url)
-            return utils.get_ftp_file_with_md5_check('ftp://' + file_url, dest_dir, md5)
+            return utils.get_ftp_file_with_md5_check('ftp://' + file_url, dest_dir, md5, accession, retries)
     print('Downloading file:' + file_url)
     if aspera:
-        return utils.get_aspera_file(file_url, dest_dir)
+        return utils.get_aspera_file(file_url, dest_dir, accession, retries)
     file_url = urlparse.quote(file_url)
-    return utils.get_ftp_file('ftp://' + file_url, dest_dir)
+    return utils.get_ftp_file('ftp://' + file_url, dest_dir, accession, retries)
 
 
-def download_file(file_url, dest_dir, md5, aspera):
+def download_file(file_url, dest_dir, md5, aspera, accession=None, size=None):
     if utils.file_exists(file_url, dest_dir, md5):
-        return
-    success = attempt_file_download(file_url, dest_dir, md5, aspera)
+        transferPlan.record_file(size, 0)
+        return utils.SKIPPED
+    # attempts are retried within utils according to its retry policy
+    with utils.transfer_slot():
+        success = attempt_file_download(file_url, dest_dir, md5, aspera, accession, 0)
     if not success:
-        success = attempt_file_download(file_url, dest_dir, md5, aspera)
-    if not success:
-        print('Failed to download file after two attempts')
+        print('Failed to download {0}'.format(file_url))
+        transferPlan.record_file(size, 0)
+        return utils.FAILED
+    transferPlan.record_file(size, size)
+    return utils.DOWNLOADED
+
+
+def download_aspera_session(transfers, dest_dir):
+    # one ascp session for all of transfers; files that did not arrive intact are retried on their own
+    start = time.time()
+    with utils.transfer_slot():
+        utils.aspera_batch_retrieve([(file_url, target_dir) for file_url, target_dir, md5, aspera, accession, size
+                                     in transfers], dest_dir)
+        statuses = []
+        for file_url, target_dir, md5, aspera, accession, size in transfers:
+            if utils.check_aspera_file(file_url, target_dir, md5, start, accession):
+                statuses.append(utils.DOWNLOADED)
+            elif utils.RETRY_ATTEMPTS > 1 and attempt_file_download(file_url, target_dir, md5, aspera, accession, 1):
+                statuses.append(utils.DOWNLOADED)
+            else:
+                print('Failed to download {0}'.format(file_url))
+                statuses.append(utils.FAILED)
+            transferPlan.record_file(size, size if statuses[-1] == utils.DOWNLOADED else 0)
+    return statuses
+
+
+def download_aspera_files(transfers, dest_dir):
+    # files already present are skipped, the rest are handed to ascp as file pair
+    # lists in as few sessions as possible, up to utils.PARALLEL_TRANSFERS at once
+    statuses = [utils.SKIPPED] * len(transfers)
+    pending = [i for i, transfer in enumerate(transfers) if not utils.file_exists(*transfer[:3])]
+    for i in range(len(transfers)):
+        if i not in pending:
+            transferPlan.record_file(transfers[i][5], 0)
+    if len(pending) == 0:
+        return statuses
+    sessions = [[pending[i] for i in session] for session in utils.split_aspera_sessions(
+        [transfers[i][0] for i in pending], utils.PARALLEL_TRANSFERS)]
+    print('Downloading {0} files with Aspera in {1} sessions'.format(len(pending), len(sessions)))
+    session_statuses = utils.run_in_order(download_aspera_session,
+                                          [([transfers[i] for i in session], dest_dir) for session in sessions],
+                                          len(sessions))
+    for session, session_status in zip(sessions, session_statuses):
+        for i, status in zip(session, session_status):
+            statuses[i] = status
+    return statuses
+
+
+def print_download_summary(accession, transfers, statuses):
+    print('{0}: {1} files downloaded, {2} already present, {3} failed'.format(
+        accession, statuses.count(utils.DOWNLOADED), statuses.count(utils.SKIPPED), statuses.count(utils.FAILED)))
+    for transfer, status in zip(transfers, statuses):
+        if status == utils.FAILED:
+            print('Failed to download file: ' + transfer[0])
 
 
 def download_meta(accession, dest_dir):
@@ -72,18 +129,67 @@ def download_meta(accession, dest_dir):
 
 def download_experiment_meta(run_accession, dest_dir):
     search_url = utils.get_experiment_search_query(run_accession)
-    response = utils.get_report_from_portal(search_url)
-    header = True
-    for line in response:
-        if header:
-            header = False
-            continue
-        experiment_accession = line.decode().strip().split('\t')[-1]
-        break
+    # read to the end, so that the response can be cached
+    lines = list(utils.get_report_from_portal(search_url))
+    experiment_accession = lines[1].decode().strip().split('\t')[-1]
     download_meta(experiment_accession, dest_dir)
 
 
-def download_files(accession, output_format, dest_dir, fetch_meta, aspera):
+def get_target_dir(accession_dir, data_accession, is_experiment):
+    # the runs of an experiment each get a directory of their own
+    if is_experiment:
+        return os.path.join(accession_dir, data_accession)
+    return accession_dir
+
+
+def download_transfers(accession, transfers, dest_dir, aspera):
+    # biggest files first by default, so the long transfers are not left running on their own at the end
+    transfers = transferPlan.order_by_size(transfers, lambda transfer: transfer[5], utils.TRANSFER_ORDER)
+    transferPlan.plan_files([(transfer[0], transfer[1], transfer[5]) for transfer in transfers], dest_dir)
+    # the Aspera flag of each transfer decides, as a manifest may give no Aspera URL for some files
+    aspera_indices = [i for i, transfer in enumerate(transfers) if transfer[3]] if aspera else []
+    if len(aspera_indices) < 2:
+        aspera_indices = []
+    other_indices = sorted(set(range(len(transfers))) - set(aspera_indices))
+    statuses = [None] * len(transfers)
+    if len(aspera_indices) > 0:
+        for i, status in zip(aspera_indices, download_aspera_files([transfers[i] for i in aspera_indices], dest_dir)):
+            statuses[i] = status
+    for i, status in zip(other_indices, utils.run_in_order(download_file, [transfers[i] for i in other_indices],
+                                                           utils.PARALLEL_TRANSFERS)):
+        statuses[i] = status
+    if len(transfers) > 0:
+        print_download_summary(accession, transfers, statuses)
+    return statuses
+
+
+def get_manifest_rows(accession, output_format, dest_dir):
+    # the files download_files would fetch, without fetching them
+    accession_dir = os.path.join(dest_dir, accession)
+    is_experiment = utils.is_experiment(accession)
+    rows = []
+    for item in utils.download_report_from_portal(utils.get_manifest_search_query(accession)):
+        rows.extend(transferManifest.get_rows(
+            item, accession, output_format,
+            lambda data_accession: get_target_dir(accession_dir, data_accession, is_experiment)))
+    return rows
+
+
+def download_manifest(manifest_file, aspera):
+    # fetches the files of a transfer manifest to the paths it gives
+    transfers = transferManifest.get_transfers(transferManifest.read_manifest(manifest_file), aspera)
+    if len(transfers) == 0:
+        print('No files listed in ' + manifest_file)
+        return []
+    for target_dir in set(transfer[1] for transfer in transfers):
+        utils.create_dir(target_dir)
+    # the directory holding all of them, for the free space check and Aspera's file pair list
+    dest_dir = os.path.commonpath([os.path.abspath(transfer[1]) for transfer in transfers])
+    return download_transfers(os.path.basename(manifest_file), transfers, dest_dir, aspera)
+
+
+def download_files(accession, output_format, dest_dir, fetch_meta, aspera, lines=None):
+    # lines are the file search rows of the accession, when already fetched along with those of others
     accession_dir = os.path.join(dest_dir, accession)
     utils.create_dir(accession_dir)
     # download experiment xml
@@ -93,20 +199,18 @@ def download_files(accession, output_format, dest_dir, fetch_meta, aspera):
     if fetch_meta and utils.is_run(accession):
         download_experiment_meta(accession, accession_dir)
     # download data files
-    search_url = utils.get_file_search_query(accession, aspera)
-
-    lines = utils.download_report_from_portal(search_url)
+    if lines is None:
+        search_url = utils.get_file_search_query(accession, aspera)
+        lines = utils.download_report_from_portal(search_url)
 
+    transfers = []
+    target_dir = accession_dir
     for line in lines:
-        data_accession, filelist, md5list = utils.parse_file_search_result_line(
+        data_accession, filelist, md5list, sizelist = utils.parse_file_search_result_line(
             line, accession, output_format, aspera)
         # create run directory if downloading all data for an experiment
-        if is_experiment:
-            run_dir = os.path.join(accession_dir, data_accession)
-            utils.create_dir(run_dir)
-            target_dir = run_dir
-        else:
-            target_dir = accession_dir
+        target_dir = get_target_dir(accession_dir, data_accession, is_experiment)
+        utils.create_dir(target_dir)
         # download run/analysis XML
         if fetch_meta:
             download_meta(data_accession, target_dir)
@@ -120,7 +224,9 @@ def download_files(accession, output_format, dest_dir, fetch_meta, aspera):
             file_url = filelist[i]
             md5 = md5list[i]
             if file_url != '':
-                download_file(file_url, target_dir, md5, aspera)
+                transfers.append((file_url, target_dir, md5, aspera, data_accession, sizelist[i]))
+    statuses = download_transfers(accession, transfers, accession_dir, aspera)
     if utils.is_empty_dir(target_dir):
         print('Deleting directory ' + os.path.basename(target_dir))
         os.rmdir(target_dir)
+    return statuses
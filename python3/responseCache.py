@@ -0,0 +1,117 @@
+#
+# responseCache.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# On-disk cache of portal search and browser XML responses, so that rerunning
+# the same command does not query ENA again for metadata it has just fetched.
+# Responses are kept in a SQLite database keyed by normalised URL, expire after
+# a time to live, and the least recently used ones are evicted once the cache
+# grows beyond its maximum size.
+
+import threading
+import time
+import urllib.parse as urlparse
+
+try:
+    import sqlite3
+except ImportError:  # Python built without SQLite, responses are then never cached
+    sqlite3 = None
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS responses (
+    url TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+)'''
+
+
+def normalize_url(url):
+    # the same query with its parameters in a different order or quoted differently is the same response
+    url_parts = urlparse.urlsplit(url)
+    query = sorted(urlparse.parse_qsl(url_parts.query, keep_blank_values=True))
+    return urlparse.urlunsplit((url_parts.scheme.lower(), url_parts.netloc.lower(), urlparse.unquote(url_parts.path),
+                                urlparse.urlencode(query), ''))
+
+
+class ResponseCache(object):
+
+    def __init__(self, path, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, url):
+        key = normalize_url(url)
+        now = time.time()
+        with self.lock:
+            try:
+                row = self.db.execute('SELECT body, created FROM responses WHERE url = ?', (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    self.db.execute('UPDATE responses SET accessed = ? WHERE url = ?', (now, key))
+                    self.db.commit()
+                    self.hits += 1
+                    return bytes(row[0])
+            except sqlite3.Error:
+                # e.g. locked by another run for too long, the response is fetched again instead
+                pass
+            self.misses += 1
+            return None
+
+    def put(self, url, body):
+        if len(body) > self.max_size:
+            return
+        now = time.time()
+        with self.lock:
+            try:
+                self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                                (normalize_url(url), body, len(body), now, now))
+                self.evict(now)
+                self.db.commit()
+            except sqlite3.Error:
+                self.db.rollback()
+
+    def evict(self, now):
+        self.db.execute('DELETE FROM responses WHERE created < ?', (now - self.ttl,))
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_size:
+            return
+        for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY accessed').fetchall():
+            self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_cache(path, ttl, max_size):
+    # None if responses cannot be cached here
+    if sqlite3 is None:
+        return None
+    try:
+        return ResponseCache(path, ttl, max_size)
+    except sqlite3.Error:
+        return None
@@ -17,9 +17,11 @@
 # limitations under the License.
 #
 
+import os
 import sys
 
 import utils
+import wgsIndex
 
 
 def write_record(dest_file, accession, output_format, expanded=False):
@@ -27,47 +29,101 @@ def write_record(dest_file, accession, output_format, expanded=False):
     print('Fetching ' + url)
     if expanded:
         url = url + '?expanded=true'
-    return utils.write_record(url, dest_file)
+    return utils.write_record(url, dest_file, accession)
+
+
+def write_record_batch(dest_file, accession_list, output_format, expanded=False):
+    url = utils.get_records_url(accession_list, output_format)
+    print('Fetching {0} records from {1}'.format(len(accession_list), url))
+    if expanded:
+        url = url + '?expanded=true'
+    if utils.write_record_batch(url, dest_file, output_format, len(accession_list)):
+        return []
+    # fall back to one request per accession to find out which ones are failing
+    failed_accessions = []
+    for accession in accession_list:
+        if not write_record(dest_file, accession, output_format, expanded):
+            failed_accessions.append(accession)
+    return failed_accessions
+
+
+def write_record_batches(dest_file, accessions, output_format, expanded=False, on_batch=None):
+    # writes the records in batches of utils.RECORD_BATCH_SIZE, calling on_batch(batch, failed_batch) after each
+    batches = utils.split_batches(accessions, utils.RECORD_BATCH_SIZE)
+    if utils.ASYNC_TRANSFERS:
+        import asyncUtils
+        return asyncUtils.write_record_batches(dest_file, batches, output_format, expanded, on_batch)
+    failed_accessions = []
+    for batch in batches:
+        failed_batch = write_record_batch(dest_file, batch, output_format, expanded)
+        failed_accessions.extend(failed_batch)
+        if on_batch is not None:
+            on_batch(batch, failed_batch)
+    return failed_accessions
 
 
 def download_sequence(dest_dir, accession, output_format, expanded):
     success = utils.download_record(dest_dir, accession, output_format, expanded)
     if not success:
         print('Unable to fetch file for {0}, format {1}'.format(accession, output_format))
+    return success
 
 
 def download_wgs(dest_dir, accession, output_format):
     if utils.is_unversioned_wgs_set(accession):
-        return download_unversioned_wgs(dest_dir, accession, output_format)
+        wgs_file_path = download_unversioned_wgs(dest_dir, accession, output_format)
     else:
-        return download_versioned_wgs(dest_dir, accession, output_format)
+        wgs_file_path = download_versioned_wgs(dest_dir, accession, output_format)
+    if wgs_file_path is not None and utils.INDEX_WGS and output_format != utils.MASTER_FORMAT:
+        wgsIndex.build_index(wgs_file_path)
+    return wgs_file_path
+
+
+def get_wgs_file_path(dest_dir, set_url):
+    return os.path.join(dest_dir, set_url.split('/')[-1])
 
 
 def download_versioned_wgs(dest_dir, accession, output_format):
     prefix = accession[:6]
     public_set_url = utils.get_wgs_ftp_url(prefix, utils.PUBLIC, output_format)
     supp_set_url = utils.get_wgs_ftp_url(prefix, utils.SUPPRESSED, output_format)
-    success = utils.get_ftp_file(public_set_url, dest_dir)
-    if not success:
-        success = utils.get_ftp_file(supp_set_url, dest_dir)
-    if not success:
-        print('No WGS set file available for {0}, format {1}'.format(accession, output_format))
-        print('Please contact ENA (https://www.ebi.ac.uk/ena/browser/support) if you feel this set should be available')
+    if utils.get_ftp_file(public_set_url, dest_dir, accession):
+        return get_wgs_file_path(dest_dir, public_set_url)
+    if utils.get_ftp_file(supp_set_url, dest_dir, accession):
+        return get_wgs_file_path(dest_dir, supp_set_url)
+    print('No WGS set file available for {0}, format {1}'.format(accession, output_format))
+    print('Please contact ENA (https://www.ebi.ac.uk/ena/browser/support) if you feel this set should be available')
+    return None
+
+
+def download_listed_wgs_set(dest_dir, accession, prefix, status, output_format):
+    # (listed, path of the downloaded set file or None) for the latest set of a status
+    set_url = utils.get_nonversioned_wgs_ftp_url(prefix, status, output_format)
+    if set_url is None:
+        return False, None
+    if utils.get_ftp_file(set_url, dest_dir, accession):
+        return True, get_wgs_file_path(dest_dir, set_url)
+    # a listing kept from an earlier run may name a version that ENA has since replaced
+    if not utils.drop_cached_wgs_listing(prefix, status):
+        return True, None
+    latest_set_url = utils.get_nonversioned_wgs_ftp_url(prefix, status, output_format)
+    if latest_set_url is None:
+        return False, None
+    if latest_set_url != set_url and utils.get_ftp_file(latest_set_url, dest_dir, accession):
+        return True, get_wgs_file_path(dest_dir, latest_set_url)
+    return True, None
 
 
 def download_unversioned_wgs(dest_dir, accession, output_format):
     prefix = accession[:4]
-    public_set_url = utils.get_nonversioned_wgs_ftp_url(prefix, utils.PUBLIC, output_format)
-    if public_set_url is not None:
-        utils.get_ftp_file(public_set_url, dest_dir)
-    else:
-        supp_set_url = utils.get_nonversioned_wgs_ftp_url(prefix, utils.SUPPRESSED, output_format)
-        if supp_set_url is not None:
-            utils.get_ftp_file(supp_set_url, dest_dir)
-        else:
+    listed, wgs_file_path = download_listed_wgs_set(dest_dir, accession, prefix, utils.PUBLIC, output_format)
+    if not listed:
+        listed, wgs_file_path = download_listed_wgs_set(dest_dir, accession, prefix, utils.SUPPRESSED, output_format)
+        if not listed:
             print('No WGS set file available for {0}, format {1}'.format(accession, output_format))
             print('Please contact ENA (https://www.ebi.ac.uk/ena/browser/support) if you feel this set should be '
                   'available')
+    return wgs_file_path
 
 
 def check_format(output_format):
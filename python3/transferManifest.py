@@ -0,0 +1,108 @@
+#
+# transferManifest.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Transfer manifests: the read and analysis files a download would fetch, with
+# where each would be written, its FTP, HTTPS and Aspera locations, MD5 and
+# size, as TSV or JSON. They are written with --manifest-only instead of
+# downloading, and can be handed to other transfer tools or read back with
+# enaDataGet --from-manifest.
+
+import json
+import os
+import sys
+import urllib.parse as urlparse
+
+import transferPlan
+import utils
+
+TSV = 'tsv'
+JSON = 'json'
+FORMATS = [TSV, JSON]
+
+FIELDS = ['accession', 'path', 'ftp_url', 'https_url', 'aspera_url', 'md5', 'bytes']
+
+
+def get_rows(item, accession, output_format, target_dir):
+    # one row per file of a portal search result, choosing the format as a download would.
+    # target_dir gives the directory a run or analysis accession would be downloaded to
+    data_accession, filelist, md5list, sizelist = utils.parse_file_search_result_line(
+        item, accession, output_format, False)
+    aspera_filelist = utils.parse_file_search_result_line(item, accession, output_format, True)[1]
+    rows = []
+    for i, file_url in enumerate(filelist):
+        if file_url == '':
+            continue
+        filename = urlparse.unquote(file_url.split('/')[-1])
+        rows.append({'accession': data_accession,
+                     'path': os.path.normpath(os.path.join(target_dir(data_accession), filename)),
+                     'ftp_url': 'ftp://' + urlparse.quote(file_url, safe='/:'),
+                     'https_url': 'https://' + urlparse.quote(file_url, safe='/:'),
+                     'aspera_url': aspera_filelist[i] if i < len(aspera_filelist) else None,
+                     'md5': md5list[i] if i < len(md5list) and md5list[i] != '' else None,
+                     'bytes': sizelist[i]})
+    return rows
+
+
+def write_manifest(rows, manifest_file, manifest_format):
+    with open(manifest_file, 'w') as f:
+        if manifest_format == JSON:
+            json.dump(rows, f, indent=2)
+            f.write('\n')
+        else:
+            f.write('\t'.join(FIELDS) + '\n')
+            for row in rows:
+                f.write('\t'.join('' if row[field] is None else str(row[field]) for field in FIELDS) + '\n')
+    print('Wrote {0} files, {1} in total, to {2}'.format(
+        len(rows), transferPlan.format_size(sum(row['bytes'] or 0 for row in rows)), manifest_file))
+
+
+def read_manifest(manifest_file):
+    # rows of a TSV or JSON manifest, told apart by the first character
+    with open(manifest_file) as f:
+        content = f.read()
+    if content.lstrip().startswith('['):
+        rows = json.loads(content)
+    else:
+        lines = content.splitlines()
+        header = lines[0].split('\t') if lines else []
+        rows = [dict(zip(header, line.split('\t'))) for line in lines[1:] if line.strip() != '']
+    for row in rows:
+        for field in ['aspera_url', 'md5', 'bytes']:
+            if row.get(field) == '':
+                row[field] = None
+        if row.get('bytes') is not None:
+            row['bytes'] = int(row['bytes'])
+    return rows
+
+
+def get_transfers(rows, aspera):
+    # (file_url, target_dir, md5, aspera, accession, size) of each row, as readGet downloads them.
+    # FTP locations are given as readGet expects them from the portal, without the scheme
+    transfers = []
+    for row in rows:
+        if aspera and row.get('aspera_url') is not None:
+            file_url = row['aspera_url']
+        elif row.get('ftp_url') is not None:
+            file_url = urlparse.unquote(row['ftp_url'][len('ftp://'):])
+        else:
+            sys.stderr.write('ERROR: No FTP location for {0} in manifest\n'.format(row.get('path')))
+            sys.exit(1)
+        transfers.append((file_url, os.path.dirname(row['path']) or '.', row.get('md5'),
+                          aspera and row.get('aspera_url') is not None, row.get('accession'), row.get('bytes')))
+    return transfers
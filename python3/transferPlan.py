@@ -0,0 +1,207 @@
+#
+# transferPlan.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Size-aware planning of read and analysis file downloads. The sizes the portal
+# gives for each file are totalled before anything is fetched, so the job can be
+# checked against the free space in the destination, the largest transfers can
+# be started first to keep every worker busy, and progress can be reported with
+# an estimated time to completion.
+
+import os
+import shutil
+import sys
+import threading
+import time
+import urllib.parse as urlparse
+
+import utils
+
+LISTED = 'listed'
+LARGEST_FIRST = 'largest-first'
+INTERLEAVED = 'interleaved'
+ORDERS = [LARGEST_FIRST, INTERLEAVED, LISTED]
+
+_progress = None
+_progress_lock = threading.Lock()
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if size < 1024 or unit == 'TB':
+            return '{0:.1f} {1}'.format(size, unit) if unit != 'B' else '{0} B'.format(size)
+        size /= 1024.0
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{0}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def order_by_size(items, get_size, order):
+    # largest-first starts the longest transfers while there is most left to run
+    # alongside them; interleaved alternates big and small so that each worker
+    # moves on from a big file to a quick one. Items of unknown size go last
+    if order == LISTED:
+        return list(items)
+    items = sorted(items, key=lambda item: -(get_size(item) or 0))
+    if order == INTERLEAVED:
+        ordered = []
+        while items:
+            ordered.append(items.pop(0))
+            if items:
+                ordered.append(items.pop())
+        return ordered
+    return items
+
+
+def get_needed_size(file_url, dest_dir, size):
+    # bytes still to be written for a file, assuming a local file of the right size is the file
+    filename = urlparse.unquote(file_url.split('/')[-1])
+    local_file = os.path.join(dest_dir, filename)
+    if os.path.isfile(local_file) and os.path.getsize(local_file) == size:
+        return 0
+    return max(size - utils.get_part_size(local_file + utils.PART_EXT), 0)
+
+
+def get_free_space(dest_dir):
+    path = os.path.abspath(dest_dir)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def check_free_space(dest_dir, needed_size):
+    free_size = get_free_space(dest_dir)
+    if needed_size > free_size:
+        sys.stderr.write('ERROR: {0} needs to be downloaded but only {1} is free in {2}\n'.format(
+            format_size(needed_size), format_size(free_size), os.path.abspath(dest_dir)))
+        sys.exit(1)
+
+
+def plan_files(files, dest_dir):
+    # files are (file_url, target_dir, size) tuples. Prints the total, checks there is
+    # room for it and adds it to the progress report, unless the whole job was planned
+    # up front, as a group is
+    if len(files) == 0 or (_progress is not None and _progress.complete):
+        return
+    total_size = sum(size for file_url, target_dir, size in files if size is not None)
+    needed_size = sum(get_needed_size(file_url, target_dir, size) for file_url, target_dir, size in files
+                      if size is not None)
+    print_plan(len(files), total_size, needed_size, sum(1 for f in files if f[2] is None))
+    check_free_space(dest_dir, needed_size)
+    with _progress_lock:
+        if _progress is None:
+            start_progress(total_size, len(files), False)
+        else:
+            _progress.extend(total_size, len(files))
+
+
+def print_plan(file_cnt, total_size, needed_size, unknown_cnt, accession_cnt=None):
+    message = '{0} files, {1} in total, {2} to download'.format(
+        file_cnt, format_size(total_size), format_size(needed_size))
+    if accession_cnt is not None:
+        message = '{0} accessions, {1}'.format(accession_cnt, message)
+    if unknown_cnt > 0:
+        message += ' ({0} files of unknown size)'.format(unknown_cnt)
+    print(message)
+
+
+def get_group_files(group_results, output_format, aspera):
+    # (file_url, size) pairs of each run or analysis of a group, from the rows of utils.get_group_file_search_results
+    group_files = {}
+    for data_accession, items in group_results.items():
+        for item in items:
+            data_accession, filelist, md5list, sizelist = utils.parse_file_search_result_line(
+                item, data_accession, output_format, aspera)
+            group_files.setdefault(data_accession, []).extend(
+                (file_url, size) for file_url, size in zip(filelist, sizelist) if file_url != '')
+    return group_files
+
+
+def plan_group(group_files, group_dir):
+    # totals a read or analysis group and checks there is room for it; returns the total size.
+    # The progress report is left to the caller, which may still ask whether to go ahead
+    files = [(file_url, os.path.join(group_dir, data_accession), size)
+             for data_accession, data_files in group_files.items() for file_url, size in data_files]
+    total_size = sum(size for file_url, target_dir, size in files if size is not None)
+    needed_size = sum(get_needed_size(file_url, target_dir, size) for file_url, target_dir, size in files
+                      if size is not None)
+    print_plan(len(files), total_size, needed_size, sum(1 for f in files if f[2] is None), len(group_files))
+    check_free_space(group_dir, needed_size)
+    return total_size
+
+
+def get_group_size(group_files, data_accession):
+    return sum(size or 0 for file_url, size in group_files.get(data_accession, []))
+
+
+def confirm(question):
+    # asks on the terminal; anything but yes is a no, as is having no terminal to ask on
+    if not sys.stdin.isatty():
+        return False
+    try:
+        return input(question + ' [y/N] ').strip().lower() in ['y', 'yes']
+    except EOFError:
+        return False
+
+
+class TransferProgress(object):
+
+    def __init__(self, total_size, file_cnt, complete):
+        # complete when the totals cover the whole job, rather than growing as accessions are planned
+        self.total_size = total_size
+        self.file_cnt = file_cnt
+        self.complete = complete
+        self.done_size = 0
+        self.done_cnt = 0
+        self.transferred = 0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def extend(self, total_size, file_cnt):
+        with self.lock:
+            self.total_size += total_size
+            self.file_cnt += file_cnt
+
+    def add(self, size, transferred):
+        # size is the whole file, transferred what was fetched of it now (0 for a file already present)
+        with self.lock:
+            self.done_cnt += 1
+            self.done_size += size or 0
+            self.transferred += transferred or 0
+            elapsed = time.time() - self.start_time
+            rate = self.transferred / elapsed if elapsed > 0 else 0
+            message = '{0} of {1} files, {2} of {3}'.format(
+                self.done_cnt, self.file_cnt, format_size(self.done_size), format_size(self.total_size))
+            if self.total_size > 0:
+                message += ' ({0:.0f}%)'.format(100.0 * min(self.done_size, self.total_size) / self.total_size)
+            if rate > 0:
+                remaining = max(self.total_size - self.done_size, 0)
+                message += ', {0}/s, ETA {1}'.format(format_size(rate), format_duration(remaining / rate))
+            print(message)
+
+
+def start_progress(total_size, file_cnt, complete=True):
+    global _progress
+    _progress = TransferProgress(total_size, file_cnt, complete)
+
+
+def record_file(size, transferred):
+    if _progress is not None:
+        _progress.add(size, transferred)
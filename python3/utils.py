@@ -17,18 +17,34 @@
 # limitations under the License.
 #
 
+import atexit
+import contextlib
+import errno
 import ftplib
 import hashlib
+import io
 import re
 import os
+import random
+import shlex
 import subprocess
 import sys
-import urllib.request as urlrequest
+import tempfile
+import threading
+import time
 import requests
+import metrics
+import responseCache
 import urllib.error as urlerror
 import urllib.parse as urlparse
 import json
+import itertools
 
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:  # not available on Windows, manifest updates are then only locked within this process
+    fcntl = None
 from configparser import ConfigParser
 
 ASPERA_BIN = 'ascp'  # ascp binary
@@ -36,6 +52,41 @@ ASPERA_PRIVATE_KEY = '/path/to/aspera_dsa.openssh'  # ascp private key file
 ASPERA_OPTIONS = ''  # set any extra aspera options
 ASPERA_SPEED = '100M'  # set aspera download speed
 
+PARALLEL_TRANSFERS = 1  # number of files downloaded concurrently, across all accessions
+PARALLEL_ACCESSIONS = 1  # number of accessions of a group processed concurrently
+RECORD_BATCH_SIZE = 100  # number of accessions requested per browser API call
+PORTAL_SEARCH_BATCH_SIZE = 500  # number of accessions whose files are looked up per portal search
+HTTP_POOL_SIZE = int(os.environ.get('ENA_HTTP_POOL_SIZE', 10))  # keep-alive connections kept per host
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('ENA_HTTP_CONNECT_TIMEOUT', 30))  # seconds
+HTTP_READ_TIMEOUT = float(os.environ.get('ENA_HTTP_READ_TIMEOUT', 300))  # seconds
+HTTP_BUFFER_SIZE = 1024 * 1024
+AVAILABILITY_PROBE_SIZE = 1024 * 1024  # bytes of a record read to check it is available
+FTP_BUFFER_SIZE = 1024 * 1024
+FTP_TIMEOUT = 300  # seconds
+FTP_POOL_SIZE = int(os.environ.get('ENA_FTP_POOL_SIZE', 4))  # idle logged in FTP connections kept per host
+FTP_NOOP_INTERVAL = 5  # seconds a pooled FTP connection may be idle before it is checked with NOOP
+REHASH = False  # ignore checksum manifests and recompute md5 of existing local files
+INDEX_WGS = False  # build a random-access index for each downloaded WGS set file
+ASYNC_TRANSFERS = False  # use the asyncio backend in asyncUtils for record fetches and group portal queries
+ASYNC_CONCURRENCY = 10  # number of requests in flight at once with the asyncio backend
+SEGMENTS = 1  # connections used to download each large file, 1 disables segmented downloads
+SEGMENT_THRESHOLD = 256 * 1024 * 1024  # files smaller than this are downloaded over one connection
+SEGMENT_CHECKPOINT_SIZE = 16 * 1024 * 1024  # bytes written by a segment between two progress records
+CACHE_DIR = os.environ.get('ENA_CACHE_DIR', os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'enaBrowserTools'))
+FTP_LISTING_TTL = float(os.environ.get('ENA_FTP_LISTING_TTL', 24 * 3600))  # seconds an FTP listing is reused
+RESPONSE_CACHE_TTL = float(os.environ.get('ENA_CACHE_TTL', 24 * 3600))  # seconds a cached response is reused
+RESPONSE_CACHE_SIZE = int(os.environ.get('ENA_CACHE_SIZE', 512)) * 1024 * 1024  # bytes, least recently used go first
+RESPONSE_CACHE_ENTRY_SIZE = 64 * 1024 * 1024  # larger responses are not cached
+RESPONSE_CACHE_FILE = 'responses.sqlite'
+RETRY_ATTEMPTS = 3  # attempts at each transfer or query before giving up
+RETRY_BACKOFF = 1.0  # seconds before the first retry, doubled for each further retry, with jitter
+RETRY_MAX_BACKOFF = 60.0  # seconds
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)  # HTTP statuses worth retrying
+CIRCUIT_BREAKER_THRESHOLD = 5  # consecutive failures after which a host is left alone for a while, 0 disables
+CIRCUIT_BREAKER_COOLDOWN = 30  # seconds a host is left alone for
+TRANSFER_ORDER = 'largest-first'  # order files and accessions are downloaded in, see transferPlan.ORDERS
+
 SUPPRESSED = 'suppressed'
 PUBLIC = 'public'
 
@@ -47,6 +98,9 @@ SUBMITTED_FORMAT = 'submitted'
 FASTQ_FORMAT = 'fastq'
 SRA_FORMAT = 'sra'
 
+PART_EXT = '.part'
+SEGMENTS_EXT = '.segments'
+CHECKSUM_MANIFEST = '.ena_checksums.tsv'
 XML_EXT = '.xml'
 EMBL_EXT = '.dat'
 FASTA_EXT = '.fasta'
@@ -54,6 +108,10 @@ WGS_EMBL_EXT = '.dat.gz'
 WGS_FASTA_EXT = '.fasta.gz'
 WGS_MASTER_EXT = '.master.dat'
 
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
 SEQUENCE = 'sequence'
 CODING = 'coding'
 WGS = 'wgs'
@@ -79,7 +137,6 @@ SEQUENCE_UPDATE_ID = 'sequence_update'
 SEQUENCE_RELEASE_ID = 'sequence_release'
 
 WGS_FTP_BASE = 'ftp://ftp.ebi.ac.uk/pub/databases/ena/wgs'
-WGS_FTP_DIR = 'pub/databases/ena/wgs'
 
 PORTAL_SEARCH_BASE = 'https://www.ebi.ac.uk/ena/portal/api/search?'
 RUN_RESULT = 'result=read_run'
@@ -99,10 +156,15 @@ INDEX_MD5_FIELD = None
 FASTQ_ASPERA_FIELD = 'fastq_aspera'
 SUBMITTED_ASPERA_FIELD = 'submitted_aspera'
 SRA_ASPERA_FIELD = 'sra_aspera'
+FASTQ_BYTES_FIELD = 'fastq_bytes'
+SUBMITTED_BYTES_FIELD = 'submitted_bytes'
+SRA_BYTES_FIELD = 'sra_bytes'
 
+header_line_pattern = re.compile(rb'\n(?:>|ID   )[^\n]*')
 sequence_pattern_1 = re.compile(r'^[A-Z]{1}[0-9]{5}(\.[0-9]+)?$')
 sequence_pattern_2 = re.compile(r'^[A-Z]{2}[0-9]{6}(\.[0-9]+)?$')
 wgs_sequence_pattern = re.compile(r'^[A-Z]{4}[0-9]{8,9}(\.[0-9]+)?$')
+wgs_sequence_bytes_pattern = re.compile(rb'^[A-Z]{4}[0-9]{8,9}(\.[0-9]+)?$')
 coding_pattern = re.compile(r'^[A-Z]{3}[0-9]{5}(\.[0-9]+)?$')
 wgs_prefix_pattern = re.compile(r'^([A-Z]{4}|[A-Z]{6})[0-9]{2}$')
 wgs_master_pattern = re.compile(r'^([A-Z]{4}|[A-Z]{6})[0-9]{2}[0]{6,9}$')
@@ -120,6 +182,26 @@ sample_pattern_3 = re.compile(r'^[EDS]RS[0-9]{6,}$')
 
 enaBrowserTools_path = os.path.dirname(os.path.dirname(__file__))
 
+_transfer_slots = threading.BoundedSemaphore(PARALLEL_TRANSFERS)
+_thread_output = threading.local()
+_thread_output_lock = threading.Lock()
+_http_session = None
+_http_session_lock = threading.Lock()
+_ftp_pool = {}  # (host, port) -> idle logged in connections
+_ftp_pool_lock = threading.Lock()
+_response_cache = None
+_metrics = None
+_circuits = {}  # host -> (consecutive failures, time until which it is left alone)
+_circuits_lock = threading.Lock()
+_ftp_listings = {}  # (host, port, directory) -> file names
+_ftp_listing_locks = {}
+_ftp_listings_listed = set()  # keys of the listings fetched from the server in this run
+_ftp_listings_lock = threading.Lock()
+_manifests = {}
+_manifest_lock = threading.Lock()
+_probed_record = None  # (url, body) of the record is_available read whole for download_record to save
+_probed_record_lock = threading.Lock()
+
 
 def is_sequence(accession):
     return sequence_pattern_1.match(accession) or sequence_pattern_2.match(accession)
@@ -249,7 +331,207 @@ def get_record_url(accession, output_format):
     return None
 
 
-def is_available(accession, output_format):
+class TransferError(IOError):
+    # a transfer that did not deliver an intact file, worth another attempt
+    pass
+
+
+class ChecksumError(TransferError):
+    pass
+
+
+class AsperaError(TransferError):
+    pass
+
+
+class CircuitOpenError(IOError):
+    # raised instead of contacting a host that has failed too many times in a row
+    pass
+
+
+def set_retry_policy(attempts, backoff, circuit_breaker_threshold):
+    if attempts < 1:
+        sys.stderr.write('ERROR: Number of attempts must be at least 1\n')
+        sys.exit(1)
+    global RETRY_ATTEMPTS, RETRY_BACKOFF, CIRCUIT_BREAKER_THRESHOLD
+    RETRY_ATTEMPTS = attempts
+    RETRY_BACKOFF = backoff
+    CIRCUIT_BREAKER_THRESHOLD = circuit_breaker_threshold
+
+
+def get_host(url):
+    # host (and port) of an ftp:// or http(s):// URL, or of an Aspera host:path
+    if '://' in url:
+        return urlparse.unquote(urlparse.urlsplit(url).netloc)
+    return url.split(':')[0]
+
+
+def is_retryable(error):
+    if isinstance(error, CircuitOpenError) or isinstance(error, requests.exceptions.SSLError):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUS_CODES
+    if getattr(error, 'status', None) in RETRY_STATUS_CODES:  # aiohttp.ClientResponseError
+        return True
+    if isinstance(error, ftplib.error_perm):
+        # 5xx replies, e.g. 550 for a file that does not exist
+        return False
+    if isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EACCES, errno.EROFS, errno.ENOENT):
+        # local problems another attempt will not fix
+        return False
+    # ftplib.error_temp covers 4xx replies such as 421, requests exceptions are OSErrors
+    return isinstance(error, (OSError, EOFError, ftplib.Error))
+
+
+def get_retry_delay(retries):
+    # exponential backoff with full jitter, so that many clients failing at once do not retry at once
+    return random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** (retries - 1)))
+
+
+def check_circuit(host):
+    with _circuits_lock:
+        failures, closed_until = _circuits.get(host, (0, 0))
+    if time.time() < closed_until:
+        raise CircuitOpenError('{0} failed {1} times in a row, not contacting it again for {2:.0f} seconds'.format(
+            host, failures, closed_until - time.time()))
+
+
+def record_host_result(host, failed):
+    # a host that keeps failing is left alone for CIRCUIT_BREAKER_COOLDOWN seconds, after
+    # which a single failure is enough to leave it alone again until it next succeeds
+    with _circuits_lock:
+        if not failed:
+            _circuits.pop(host, None)
+            return
+        failures, closed_until = _circuits.get(host, (0, 0))
+        failures += 1
+        tripped = 0 < CIRCUIT_BREAKER_THRESHOLD <= failures
+        if tripped:
+            closed_until = time.time() + CIRCUIT_BREAKER_COOLDOWN
+        _circuits[host] = (failures, closed_until)
+    if tripped:
+        sys.stderr.write('{0} failed {1} times in a row, leaving it alone for {2} seconds\n'.format(
+            host, failures, CIRCUIT_BREAKER_COOLDOWN))
+        if _metrics is not None:
+            _metrics.record_circuit_trip(host)
+
+
+def get_attempt_retry_delay(url, error, retries):
+    # records a failed attempt at url, with retries the number of attempts made so far including
+    # this one. Returns the delay before the next attempt, or None if the error is to be raised
+    retryable = is_retryable(error)
+    # errors not worth retrying still mean the host answered
+    record_host_result(get_host(url), retryable)
+    if not retryable or retries >= RETRY_ATTEMPTS:
+        return None
+    delay = get_retry_delay(retries)
+    sys.stderr.write('{0} for {1}, retrying in {2:.1f} seconds ({3} of {4} attempts made)\n'.format(
+        type(error).__name__, url, delay, retries, RETRY_ATTEMPTS))
+    if _metrics is not None:
+        _metrics.record_retry(get_protocol(url) or 'aspera', type(error).__name__)
+    return delay
+
+
+def call_with_retries(url, func, retries=0):
+    # calls func(retries) until it returns, with retries the number of attempts made so far.
+    # The last error is raised once it is not worth retrying or RETRY_ATTEMPTS have been made
+    host = get_host(url)
+    while True:
+        check_circuit(host)
+        try:
+            result = func(retries)
+        except Exception as e:
+            retries += 1
+            delay = get_attempt_retry_delay(url, e, retries)
+            if delay is None:
+                raise
+            time.sleep(delay)
+        else:
+            record_host_result(host, False)
+            return result
+
+
+def set_http_pool_size(pool_size):
+    global HTTP_POOL_SIZE, _http_session
+    with _http_session_lock:
+        HTTP_POOL_SIZE = pool_size
+        if _http_session is not None:
+            _http_session.close()
+            _http_session = None
+
+
+def get_http_session():
+    # one keep-alive session for the whole process, so that browser API and portal
+    # requests reuse connections instead of paying a TCP and TLS handshake each
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+def http_get(url, stream=False, headers=None):
+    return http_request('GET', url, stream, headers)
+
+
+def http_post(url, data):
+    return http_request('POST', url, data=data)
+
+
+def http_send(method, url, stream=False, headers=None, data=None):
+    # a single attempt, for callers that apply the retry policy themselves, as file transfers do
+    return get_http_session().request(method, url, stream=stream, headers=headers, data=data,
+                                      timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+
+
+def http_request(method, url, stream=False, headers=None, data=None):
+    # retried on connection errors and RETRY_STATUS_CODES; once out of attempts the
+    # last response is returned whatever its status, for the caller to deal with
+    def attempt(retries):
+        response = http_send(method, url, stream, headers, data)
+        if response.status_code in RETRY_STATUS_CODES:
+            if retries + 1 < RETRY_ATTEMPTS:
+                response.close()
+            response.raise_for_status()
+        return response
+    try:
+        return call_with_retries(url, attempt)
+    except requests.exceptions.HTTPError as e:
+        return e.response
+
+
+def get_response_lines(response):
+    # byte lines of a streamed response, including line endings
+    pending = b''
+    for chunk in response.iter_content(chunk_size=HTTP_BUFFER_SIZE):
+        data = pending + chunk
+        end = data.rfind(b'\n') + 1
+        pending = data[end:]
+        for line in io.BytesIO(data[:end]):
+            yield line
+    if pending:
+        yield pending
+
+
+def get_records_url(accession_list, output_format):
+    return get_record_url(','.join(accession_list), output_format)
+
+
+def split_batches(accessions, batch_size):
+    iterator = iter(accessions)
+    batch = list(itertools.islice(iterator, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, batch_size))
+
+
+def is_available(accession, output_format, expanded=False, keep=False):
+    # keep is for callers about to save the record checked with download_record, with the
+    # same expanded, which can then reuse the body read here instead of fetching it again
     if is_taxid(accession):
         url = get_record_url('Taxon:{0}'.format(accession), XML_FORMAT)
     elif is_study(accession) or is_sample(accession) or is_assembly(accession):
@@ -258,16 +540,62 @@ def is_available(accession, output_format):
         url = get_record_url(accession, output_format)
         if url == None:
             url = get_record_url(accession, XML_FORMAT)
+        elif expanded:
+            url = url + '?expanded=true'
     try:
         print('Checking availability of ' + url)
-        response = requests.get(url)
-        return response.status_code == 200 and len(response.content) != 0
-    except urlerror.URLError as e:
+        is_xml = url.startswith(VIEW_URL_BASE + XML_DISPLAY)
+        body = get_cached_response(url) if is_xml else None
+        if body is None:
+            body, complete = probe_record(url)
+            if body is None:
+                return False
+            if complete:
+                if keep:
+                    keep_probed_record(url, body)
+                if is_xml:
+                    cache_response(url, body)
+        return len(body) != 0
+    except (urlerror.URLError, requests.exceptions.SSLError) as e:
         print_certificate_failed_error(e)
     except Exception as e:
         raise
 
 
+def probe_record(url):
+    # (body, complete) for the start of a record, or (None, False) if it could not be fetched.
+    # Reading stops after AVAILABILITY_PROBE_SIZE bytes, so a large record is not downloaded
+    # once to check it is there and again to save it
+    with http_get(url, stream=True) as response:
+        if response.status_code != 200:
+            return None, False
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=HTTP_BUFFER_SIZE):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > AVAILABILITY_PROBE_SIZE:
+                return b''.join(chunks), False
+        return b''.join(chunks), True
+
+
+def keep_probed_record(url, body):
+    # only the last record checked is kept, so one that is not downloaded after all is soon dropped
+    global _probed_record
+    with _probed_record_lock:
+        _probed_record = (url, body)
+
+
+def pop_probed_record(url):
+    global _probed_record
+    with _probed_record_lock:
+        if _probed_record is None or _probed_record[0] != url:
+            return None
+        body = _probed_record[1]
+        _probed_record = None
+        return body
+
+
 def get_filename(base_name, output_format):
     if output_format == XML_FORMAT:
         return base_name + XML_EXT
@@ -285,8 +613,41 @@ def get_destination_file(dest_dir, accession, output_format):
     return None
 
 
+def check_record_start(first_chunk):
+    # the browser API answers a missing record with a message, not an error status
+    if first_chunk.startswith(b'Entry:'):
+        raise IOError(first_chunk.decode('utf-8', 'replace').strip())
+
+
 def download_single_record(url, dest_file):
-    urlrequest.urlretrieve(url, dest_file)
+    body = pop_probed_record(url)
+    if body is not None:
+        check_record_start(body)
+        with open(dest_file, 'wb') as f:
+            f.write(body)
+        return
+    with http_get(url, stream=True) as response:
+        response.raise_for_status()
+        chunks = response.iter_content(chunk_size=HTTP_BUFFER_SIZE)
+        first_chunk = next(chunks, b'')
+        check_record_start(first_chunk)
+        with open(dest_file, 'wb') as f:
+            f.write(first_chunk)
+            for chunk in chunks:
+                f.write(chunk)
+
+
+def download_cached_record(url, dest_file):
+    body = pop_probed_record(url)
+    if body is None:
+        body = get_cached_response(url)
+    if body is None:
+        response = http_get(url)
+        response.raise_for_status()
+        body = response.content
+        cache_response(url, body)
+    with open(dest_file, 'wb') as f:
+        f.write(body)
 
 
 def download_record(dest_dir, accession, output_format, expanded=False):
@@ -297,33 +658,415 @@ def download_record(dest_dir, accession, output_format, expanded=False):
         url = get_record_url(accession, output_format)
         if expanded:
             url = url + '?expanded=true'
-        download_single_record(url, dest_file)
+        if output_format == XML_FORMAT:
+            download_cached_record(url, dest_file)
+        else:
+            download_single_record(url, dest_file)
         return True
     except Exception as e:
         print("Error downloading read record: {0}".format(e))
         return False
 
 
-def write_record(url, dest_file):
+def write_record(url, dest_file, accession=None):
+    start = time.time()
+    offset = dest_file.tell()
+    error = None
     try:
-        response = urlrequest.urlopen(url)
-        linenum = 1
-        for line in response:
-            if linenum == 1 and line.startswith(b'Entry:'):
+        with http_get(url, stream=True) as response:
+            if response.status_code != 200:
+                error = 'HTTPError'
                 return False
-            chars = dest_file.write(line)
-            linenum += 1
+            linenum = 1
+            for line in get_response_lines(response):
+                if linenum == 1 and line.startswith(b'Entry:'):
+                    error = 'RecordNotFound'
+                    return False
+                chars = dest_file.write(line)
+                linenum += 1
         dest_file.flush()
         return True
-    except Exception:
+    except Exception as e:
+        error = e
         return False
+    finally:
+        record_transfer(url, get_protocol(url), start, dest_file.tell() - offset, accession, error=error)
+
+
+def write_record_batch(url, dest_file, output_format, record_cnt):
+    # a batch only counts as written if every requested record came back,
+    # otherwise whatever was written is truncated away again
+    start_time = time.time()
+    start = dest_file.tell()
+    error = 'IncompleteBatch'
+    try:
+        found_cnt = 0
+        with http_get(url, stream=True) as response:
+            if response.status_code == 200:
+                linenum = 1
+                for line in get_response_lines(response):
+                    if linenum == 1 and line.startswith(b'Entry:'):
+                        break
+                    if record_start_line(line, output_format):
+                        found_cnt += 1
+                    dest_file.write(line)
+                    linenum += 1
+            else:
+                error = 'HTTPError'
+        if found_cnt == record_cnt:
+            dest_file.flush()
+            record_transfer(url, get_protocol(url), start_time, dest_file.tell() - start, records=record_cnt)
+            return True
+    except Exception as e:
+        error = e
+    record_transfer(url, get_protocol(url), start_time, dest_file.tell() - start, error=error, records=record_cnt)
+    dest_file.seek(start)
+    dest_file.truncate()
+    return False
+
+
+def get_part_size(part_file):
+    if os.path.isfile(part_file):
+        return os.path.getsize(part_file)
+    return 0
+
 
+def open_part_file(part_file, offset):
+    # the md5 is updated as bytes are written, so only bytes left over from an
+    # earlier attempt ever need to be read back from disk
+    if offset > 0:
+        return open(part_file, 'ab'), get_md5_hash(part_file)
+    return open(part_file, 'wb'), hashlib.md5()
 
-def get_ftp_file(ftp_url, dest_dir):
+
+def split_ftp_url(ftp_url):
+    url_parts = urlparse.urlsplit(ftp_url)
+    host, _, port = urlparse.unquote(url_parts.netloc).partition(':')
+    return host, int(port) if port else 21, urlparse.unquote(url_parts.path)
+
+
+def open_ftp(host, port):
+    ftp = ftplib.FTP(timeout=FTP_TIMEOUT)
     try:
-        filename = urlparse.unquote(ftp_url.split('/')[-1])
-        dest_file = os.path.join(dest_dir, filename)
-        urlrequest.urlretrieve(ftp_url, dest_file)
+        ftp.connect(host, port)
+        ftp.login()
+        ftp.voidcmd('TYPE I')
+    except Exception:
+        ftp.close()
+        raise
+    return ftp
+
+
+def acquire_ftp(host, port):
+    # the server drops connections that stay idle for too long, so a pooled one
+    # that has not been used for a while is only handed out after it answered a NOOP
+    while True:
+        with _ftp_pool_lock:
+            idle = _ftp_pool.get((host, port))
+            ftp, released = idle.pop() if idle else (None, None)
+        if ftp is None:
+            return open_ftp(host, port)
+        if time.time() - released < FTP_NOOP_INTERVAL:
+            return ftp
+        try:
+            ftp.voidcmd('NOOP')
+            return ftp
+        except (ftplib.all_errors + (EOFError,)):
+            ftp.close()
+
+
+def release_ftp(ftp, host, port):
+    with _ftp_pool_lock:
+        idle = _ftp_pool.setdefault((host, port), [])
+        if len(idle) < FTP_POOL_SIZE:
+            idle.append((ftp, time.time()))
+            return
+    ftp.close()
+
+
+@contextlib.contextmanager
+def ftp_connection(host, port):
+    # a logged in connection in binary mode, shared by all transfers from the same
+    # host; it only goes back to the pool if it was used without error
+    ftp = acquire_ftp(host, port)
+    try:
+        yield ftp
+    except BaseException:
+        ftp.close()
+        raise
+    release_ftp(ftp, host, port)
+
+
+def close_ftp_pool():
+    with _ftp_pool_lock:
+        connections = [ftp for idle in _ftp_pool.values() for ftp, released in idle]
+        _ftp_pool.clear()
+    for ftp in connections:
+        try:
+            ftp.quit()
+        except (ftplib.all_errors + (EOFError,)):
+            ftp.close()
+
+
+atexit.register(close_ftp_pool)
+
+
+def ftp_resumable_retrieve(ftp_url, part_file):
+    host, port, path = split_ftp_url(ftp_url)
+    offset = get_part_size(part_file)
+    with ftp_connection(host, port) as ftp:
+        size = ftp.size(path)
+        if size is not None and offset > size:
+            offset = 0
+        f, hash_md5 = open_part_file(part_file, offset)
+        with f:
+            if size is None or offset < size:
+                def write_block(block):
+                    f.write(block)
+                    hash_md5.update(block)
+                ftp.retrbinary('RETR ' + path, write_block, FTP_BUFFER_SIZE, rest=offset if offset > 0 else None)
+        if size is not None and get_part_size(part_file) != size:
+            raise IOError('incomplete transfer of {0}: {1} of {2} bytes'.format(
+                ftp_url, get_part_size(part_file), size))
+        return hash_md5
+
+
+def http_resumable_retrieve(url, part_file):
+    offset = get_part_size(part_file)
+    headers = {'Range': 'bytes={0}-'.format(offset)} if offset > 0 else None
+    # retried as a whole by retrieve_with_retries
+    with http_send('GET', url, stream=True, headers=headers) as response:
+        if response.status_code == 416:
+            # requested range starts at or beyond the end: either complete or stale
+            total = response.headers.get('Content-Range', '').split('/')[-1]
+            if total.isdigit() and int(total) == offset:
+                return get_md5_hash(part_file)
+            os.remove(part_file)
+            return http_resumable_retrieve(url, part_file)
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        f, hash_md5 = open_part_file(part_file, offset)
+        with f:
+            for chunk in response.iter_content(chunk_size=HTTP_BUFFER_SIZE):
+                f.write(chunk)
+                hash_md5.update(chunk)
+        length = response.headers.get('Content-Length')
+        if length is not None and get_part_size(part_file) != offset + int(length):
+            raise IOError('incomplete transfer of {0}: {1} of {2} bytes'.format(
+                url, get_part_size(part_file), offset + int(length)))
+        return hash_md5
+
+
+def get_remote_size(url):
+    # size of a remote file, or None if it is unknown or cannot be fetched in byte ranges
+    if url.startswith('ftp://'):
+        host, port, path = split_ftp_url(url)
+        with ftp_connection(host, port) as ftp:
+            return ftp.size(path)
+    response = get_http_session().head(url, allow_redirects=True, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    length = response.headers.get('Content-Length')
+    if response.status_code != 200 or response.headers.get('Accept-Ranges') != 'bytes' or length is None:
+        return None
+    return int(length)
+
+
+def get_segmented_size(url, part_file):
+    # size of the file if it is to be downloaded in segments, otherwise None
+    segments_file = part_file + SEGMENTS_EXT
+    if os.path.isfile(segments_file):
+        # the part file of a segmented download is preallocated, not a prefix of the file, so it can
+        # only be resumed in segments, whatever SEGMENTS and SEGMENT_THRESHOLD are set to now
+        size = read_segments_size(segments_file)
+        if size is not None and get_part_size(part_file) == size and get_remote_size(url) == size:
+            return size
+        for stale_file in [part_file, segments_file]:
+            if os.path.isfile(stale_file):
+                os.remove(stale_file)
+    if SEGMENTS < 2:
+        return None
+    if os.path.isfile(part_file):
+        # an interrupted single connection download, carry on with that one
+        return None
+    size = get_remote_size(url)
+    if not size or size < SEGMENT_THRESHOLD:
+        return None
+    return size
+
+
+def plan_segments(size, segment_cnt):
+    # [start, end, bytes written] of each segment
+    segment_size = -(-size // segment_cnt)
+    return [[start, min(start + segment_size, size), 0] for start in range(0, size, segment_size)]
+
+
+def read_segments_size(segments_file):
+    with open(segments_file) as f:
+        line = f.readline().strip()
+    return int(line) if line.isdigit() else None
+
+
+def read_segments(segments_file, size):
+    # progress of an earlier attempt at a file of this size, or None if there is none
+    if not os.path.isfile(segments_file):
+        return None
+    with open(segments_file) as f:
+        lines = f.read().splitlines()
+    try:
+        if not lines or int(lines[0]) != size:
+            return None
+        return [[int(value) for value in line.split('\t')] for line in lines[1:]]
+    except ValueError:
+        return None
+
+
+def write_segments(segments_file, size, segments):
+    with open(segments_file + PART_EXT, 'w') as f:
+        f.write('{0}\n'.format(size))
+        for segment in segments:
+            f.write('{0}\t{1}\t{2}\n'.format(*segment))
+    os.replace(segments_file + PART_EXT, segments_file)
+
+
+def preallocate(part_file, size):
+    with open(part_file, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # not available on this platform or file system, a sparse file does as well
+            f.truncate(size)
+
+
+def http_read_range(url, start, end):
+    headers = {'Range': 'bytes={0}-{1}'.format(start, end - 1)}
+    with http_send('GET', url, stream=True, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError('byte range request not supported for {0} ({1})'.format(url, response.status_code))
+        for chunk in response.iter_content(chunk_size=HTTP_BUFFER_SIZE):
+            yield chunk
+
+
+def ftp_read_range(ftp_url, start, end):
+    host, port, path = split_ftp_url(ftp_url)
+    ftp = acquire_ftp(host, port)
+    try:
+        # the data connection is dropped once the range is read, so the server
+        # reply to the aborted RETR is never waited for and the control
+        # connection cannot go back to the pool
+        conn = ftp.transfercmd('RETR ' + path, rest=start if start > 0 else None)
+        with conn:
+            remaining = end - start
+            while remaining > 0:
+                block = conn.recv(min(FTP_BUFFER_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+    finally:
+        ftp.close()
+
+
+def retrieve_segment(url, part_file, segment, checkpoint):
+    start, end, written = segment
+    if start + written >= end:
+        return
+    read_range = ftp_read_range if url.startswith('ftp://') else http_read_range
+    with open(part_file, 'r+b') as f:
+        f.seek(start + written)
+        for block in read_range(url, start + written, end):
+            block = block[:end - start - written]
+            f.write(block)
+            written += len(block)
+            if written - segment[2] >= SEGMENT_CHECKPOINT_SIZE:
+                # only bytes handed over to the OS are recorded as written
+                f.flush()
+                segment[2] = written
+                checkpoint()
+    segment[2] = written
+    checkpoint()
+    if start + written != end:
+        raise IOError('incomplete transfer of {0}: {1} of {2} bytes in segment starting at {3}'.format(
+            url, written, end - start, start))
+
+
+def segmented_retrieve(url, part_file, size):
+    # byte ranges of the file are fetched over SEGMENTS connections and written in
+    # place into the preallocated part file; progress is kept in part_file.segments
+    # so that an interrupted download only fetches what is missing
+    segments_file = part_file + SEGMENTS_EXT
+    segments = read_segments(segments_file, size)
+    if segments is None or get_part_size(part_file) != size:
+        segments = plan_segments(size, SEGMENTS)
+        preallocate(part_file, size)
+        write_segments(segments_file, size, segments)
+    segments_lock = threading.Lock()
+
+    def checkpoint():
+        with segments_lock:
+            write_segments(segments_file, size, segments)
+
+    with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+        futures = [executor.submit(retrieve_segment, url, part_file, segment, checkpoint) for segment in segments]
+        for future in futures:
+            future.result()
+    os.remove(segments_file)
+    # segments arrive out of order, so the md5 can only be computed once they are all in
+    return get_md5_hash(part_file)
+
+
+def resumable_retrieve(url, dest_file):
+    # bytes are written to dest_file.part so that a failed transfer can continue
+    # from where it stopped; only a complete file is moved into place.
+    # returns the md5 of the complete file
+    part_file = dest_file + PART_EXT
+    segmented_size = get_segmented_size(url, part_file)
+    if segmented_size is not None:
+        hash_md5 = segmented_retrieve(url, part_file, segmented_size)
+    elif url.startswith('ftp://'):
+        hash_md5 = ftp_resumable_retrieve(url, part_file)
+    else:
+        hash_md5 = http_resumable_retrieve(url, part_file)
+    os.replace(part_file, dest_file)
+    return hash_md5.hexdigest()
+
+
+def retrieve_with_retries(url, protocol, dest_file, retrieve, md5, accession, retries):
+    # calls retrieve() under the retry policy, recording each attempt as a transfer.
+    # retrieve returns the md5 of the file it wrote, or None to have it read back
+    def attempt(retries):
+        start = time.time()
+        offset = get_part_size(dest_file + PART_EXT)
+        md5_outcome = None
+        transferred = None
+        try:
+            generated_md5 = retrieve()
+            transferred = get_transferred_size(dest_file, offset)
+            if md5 is not None:
+                md5_outcome = get_md5_outcome(check_md5(dest_file, md5, generated_md5))
+                if md5_outcome == 'mismatch':
+                    raise ChecksumError('MD5 mismatch for downloaded file ' + dest_file)
+        except Exception as e:
+            if transferred is None:
+                transferred = get_transferred_size(dest_file, offset)
+            record_transfer(url, protocol, start, transferred, accession, retries, md5_outcome, error=e)
+            raise
+        record_transfer(url, protocol, start, transferred, accession, retries, md5_outcome)
+    call_with_retries(url, attempt, retries)
+
+
+def aspera_retrieve_or_raise(aspera_url, dest_dir, dest_file):
+    if not asperaretrieve(aspera_url, dest_dir, dest_file):
+        raise AsperaError('ascp failed to fetch ' + aspera_url)
+
+
+def get_ftp_file(ftp_url, dest_dir, accession=None, retries=0):
+    # retries is the number of attempts already made at this file
+    filename = urlparse.unquote(ftp_url.split('/')[-1])
+    dest_file = os.path.join(dest_dir, filename)
+    try:
+        retrieve_with_retries(ftp_url, get_protocol(ftp_url), dest_file,
+                              lambda: resumable_retrieve(ftp_url, dest_file), None, accession, retries)
         return True
     except Exception as e:
         sys.stderr.write("Error with FTP transfer: {0}".format(e))
@@ -331,11 +1074,13 @@ def get_ftp_file(ftp_url, dest_dir):
         return False
 
 
-def get_aspera_file(aspera_url, dest_dir):
+def get_aspera_file(aspera_url, dest_dir, accession=None, retries=0):
+    filename = aspera_url.split('/')[-1]
+    dest_file = os.path.join(dest_dir, filename)
     try:
-        filename = aspera_url.split('/')[-1]
-        dest_file = os.path.join(dest_dir, filename)
-        asperaretrieve(aspera_url, dest_dir, dest_file)
+        retrieve_with_retries(aspera_url, 'aspera', dest_file,
+                              lambda: aspera_retrieve_or_raise(aspera_url, dest_dir, dest_file), None, accession,
+                              retries)
         return True
     except Exception as e:
         sys.stderr.write("Error with FTP transfer: {0}".format(e))
@@ -343,56 +1088,148 @@ def get_aspera_file(aspera_url, dest_dir):
         return False
 
 
-def get_md5(filepath):
+def get_md5_hash(filepath):
     hash_md5 = hashlib.md5()
     with open(filepath, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(FTP_BUFFER_SIZE), b""):
             hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    return hash_md5
+
+
+def get_md5(filepath):
+    return get_md5_hash(filepath).hexdigest()
 
 
-def check_md5(filepath, expected_md5):
-    generated_md5 = get_md5(filepath)
+def check_md5(filepath, expected_md5, generated_md5=None):
+    # files written by resumable_retrieve come with their md5 already computed,
+    # anything else (e.g. Aspera downloads) is read back from disk
+    if generated_md5 is None:
+        generated_md5 = get_md5(filepath)
     if expected_md5 != generated_md5:
         print('MD5 mismatch for downloaded file ' + filepath + '. Deleting file')
         print('generated md5', generated_md5)
         print('expected md5', expected_md5)
         os.remove(filepath)
         return False
+    record_verified_md5(filepath, generated_md5)
     return True
 
 
+def set_index_wgs(index_wgs):
+    global INDEX_WGS
+    INDEX_WGS = index_wgs
+
+
+def set_rehash(rehash):
+    global REHASH
+    REHASH = rehash
+
+
+def lock_manifest(f, exclusive):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def unlock_manifest(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_checksum_manifest(dest_dir):
+    # each destination directory has an append-only manifest of the files whose md5
+    # has been verified (filename, size, mtime, inode, md5). Later lines win, and
+    # only lines appended since the last read are parsed
+    manifest_path = os.path.join(dest_dir, CHECKSUM_MANIFEST)
+    manifest = _manifests.setdefault(dest_dir, {'offset': 0, 'entries': {}})
+    if not os.path.isfile(manifest_path):
+        return manifest['entries']
+    with open(manifest_path, 'rb') as f:
+        lock_manifest(f, False)
+        try:
+            if os.fstat(f.fileno()).st_size < manifest['offset']:
+                manifest['offset'] = 0
+                manifest['entries'] = {}
+            f.seek(manifest['offset'])
+            data = f.read()
+        finally:
+            unlock_manifest(f)
+    end = data.rfind(b'\n') + 1
+    manifest['offset'] += end
+    for line in data[:end].decode('utf-8').splitlines():
+        fields = line.split('\t')
+        if len(fields) == 5:
+            manifest['entries'][fields[0]] = tuple(fields[1:])
+    return manifest['entries']
+
+
+def get_manifest_entry(local_file):
+    dest_dir, filename = os.path.split(local_file)
+    stat = os.stat(local_file)
+    return filename, (str(stat.st_size), str(stat.st_mtime_ns), str(stat.st_ino))
+
+
+def get_recorded_md5(local_file):
+    dest_dir = os.path.dirname(local_file)
+    filename, file_stat = get_manifest_entry(local_file)
+    with _manifest_lock:
+        entry = read_checksum_manifest(dest_dir).get(filename)
+    if entry is not None and entry[:3] == file_stat:
+        return entry[3]
+    return None
+
+
+def record_verified_md5(local_file, md5):
+    dest_dir = os.path.dirname(local_file)
+    filename, file_stat = get_manifest_entry(local_file)
+    if '\t' in filename or '\n' in filename:
+        return
+    line = '\t'.join((filename,) + file_stat + (md5,)) + '\n'
+    with _manifest_lock:
+        with open(os.path.join(dest_dir, CHECKSUM_MANIFEST), 'ab') as f:
+            lock_manifest(f, True)
+            try:
+                f.write(line.encode('utf-8'))
+                f.flush()
+            finally:
+                unlock_manifest(f)
+
+
 def file_exists(file_url, dest_dir, md5):
     filename = urlparse.unquote(file_url.split('/')[-1])
     local_file = os.path.join(dest_dir, filename)
     if os.path.isfile(local_file):
-        generated_md5 = get_md5(local_file)
+        generated_md5 = None if REHASH else get_recorded_md5(local_file)
+        if generated_md5 is None:
+            generated_md5 = get_md5(local_file)
+            if generated_md5 == md5:
+                record_verified_md5(local_file, generated_md5)
         if generated_md5 == md5:
             print('{0} already exists in local directory, skipping'.format(filename))
             return True
     return False
 
 
-def get_ftp_file_with_md5_check(ftp_url, dest_dir, md5):
+def get_ftp_file_with_md5_check(ftp_url, dest_dir, md5, accession=None, retries=0):
+    filename = urlparse.unquote(ftp_url.split('/')[-1])
+    dest_file = os.path.join(dest_dir, filename)
     try:
-        filename = urlparse.unquote(ftp_url.split('/')[-1])
-        dest_file = os.path.join(dest_dir, filename)
-        urlrequest.urlretrieve(ftp_url, dest_file)
-        return check_md5(dest_file, md5)
+        retrieve_with_retries(ftp_url, get_protocol(ftp_url), dest_file,
+                              lambda: resumable_retrieve(ftp_url, dest_file), md5, accession, retries)
+        return True
     except Exception as e:
         sys.stderr.write("Error with FTP transfer: {0}\n".format(e))
         sys.stderr.write("Error with FTP transfer occurred for file: {}".format(filename))
         return False
 
 
-def get_aspera_file_with_md5_check(aspera_url, dest_dir, md5):
+def get_aspera_file_with_md5_check(aspera_url, dest_dir, md5, accession=None, retries=0):
+    filename = aspera_url.split('/')[-1]
+    dest_file = os.path.join(dest_dir, filename)
     try:
-        filename = aspera_url.split('/')[-1]
-        dest_file = os.path.join(dest_dir, filename)
-        success = asperaretrieve(aspera_url, dest_dir, dest_file)
-        if success:
-            return check_md5(dest_file, md5)
-        return False
+        retrieve_with_retries(aspera_url, 'aspera', dest_file,
+                              lambda: aspera_retrieve_or_raise(aspera_url, dest_dir, dest_file), md5, accession,
+                              retries)
+        return True
     except Exception as e:
         sys.stderr.write("Error with Aspera transfer: {0}\n".format(e))
         sys.stderr.write("Error with Aspera transfer occurred for file: {}".format(filename))
@@ -450,29 +1287,233 @@ def set_aspera(aspera_filepath):
     return aspera
 
 
+def get_aspera_command(logdir, args):
+    # argument list for ascp, run without a shell so that paths and options are passed as they are
+    return ([ASPERA_BIN, '-QT', '-L', logdir, '-l', ASPERA_SPEED, '-P33001'] + shlex.split(ASPERA_OPTIONS)
+            + ['-i', ASPERA_PRIVATE_KEY] + args)
+
+
+def run_aspera(dest_dir, args):
+    # True if ascp exited successfully
+    logdir = os.path.abspath(os.path.join(dest_dir, "logs"))
+    print('Creating', logdir)
+    create_dir(logdir)
+    command = get_aspera_command(logdir, args)
+    print(' '.join(shlex.quote(arg) for arg in command))
+    exit_status = subprocess.call(command)
+    if exit_status != 0:
+        sys.stderr.write("Error with Aspera transfer: ascp exited with status {0}\n".format(exit_status))
+        return False
+    return True
+
+
 def asperaretrieve(url, dest_dir, dest_file):
     try:
-        logdir = os.path.abspath(os.path.join(dest_dir, "logs"))
-        print('Creating', logdir)
-        create_dir(logdir)
-        aspera_line = "{bin} -QT -L {logs} -l {speed} -P33001 {aspera} -i {key} era-fasp@{file} {outdir}"
-        aspera_line = aspera_line.format(
-            bin=ASPERA_BIN,
-            outdir=dest_dir,
-            logs=logdir,
-            file=url,
-            aspera=ASPERA_OPTIONS,
-            key=ASPERA_PRIVATE_KEY,
-            speed=ASPERA_SPEED,
-        )
-        print(aspera_line)
-        subprocess.call(aspera_line, shell=True)  # this blocks so we're fine to wait and return True
-        return True
+        return run_aspera(dest_dir, ['era-fasp@' + url, dest_dir])
     except Exception as e:
         sys.stderr.write("Error with Aspera transfer: {0}\n".format(e))
         return False
 
 
+def aspera_batch_retrieve(files, dest_dir):
+    # fetches files, given as (aspera_url, target_dir) pairs on a single host with
+    # each target_dir within dest_dir, in one ascp session. Files may have been
+    # transferred even if the session failed, so each needs checking on its own
+    host = files[0][0].split(':')[0]
+    pair_list = None
+    try:
+        create_dir(dest_dir)
+        with tempfile.NamedTemporaryFile('w', prefix='.ascp_pairs_', suffix='.txt', dir=dest_dir,
+                                         delete=False) as f:
+            pair_list = f.name
+            for aspera_url, target_dir in files:
+                source = aspera_url.split(':', 1)[1]
+                f.write(source + '\n')
+                f.write(os.path.relpath(os.path.join(target_dir, source.split('/')[-1]), dest_dir) + '\n')
+        return run_aspera(dest_dir, ['--mode=recv', '--user=era-fasp', '--host=' + host,
+                                     '--file-pair-list=' + pair_list, dest_dir])
+    except Exception as e:
+        sys.stderr.write("Error with Aspera transfer: {0}\n".format(e))
+        return False
+    finally:
+        if pair_list is not None and os.path.isfile(pair_list):
+            os.remove(pair_list)
+
+
+def check_aspera_file(aspera_url, target_dir, md5, start, accession=None):
+    # outcome of one file of an Aspera batch, recorded as a transfer of its own
+    dest_file = os.path.join(target_dir, aspera_url.split('/')[-1])
+    if not os.path.isfile(dest_file):
+        record_transfer(aspera_url, 'aspera', start, 0, accession, error='AsperaError')
+        return False
+    transferred = os.path.getsize(dest_file)
+    if md5 is None:
+        record_transfer(aspera_url, 'aspera', start, transferred, accession)
+        return True
+    success = check_md5(dest_file, md5)
+    record_transfer(aspera_url, 'aspera', start, transferred, accession, md5=get_md5_outcome(success))
+    return success
+
+
+def split_aspera_sessions(aspera_urls, session_cnt):
+    # positions of aspera_urls grouped by host, then dealt round robin across up to session_cnt sessions per host
+    hosts = {}
+    for i, aspera_url in enumerate(aspera_urls):
+        hosts.setdefault(aspera_url.split(':')[0], []).append(i)
+    sessions = []
+    for positions in hosts.values():
+        cnt = min(session_cnt, len(positions))
+        sessions.extend(positions[i::cnt] for i in range(cnt))
+    return sessions
+
+
+def set_parallel_transfers(parallel):
+    if parallel < 1:
+        sys.stderr.write('ERROR: Number of parallel downloads must be at least 1\n')
+        sys.exit(1)
+    global PARALLEL_TRANSFERS, FTP_POOL_SIZE, _transfer_slots
+    PARALLEL_TRANSFERS = parallel
+    _transfer_slots = threading.BoundedSemaphore(parallel)
+    if parallel > HTTP_POOL_SIZE:
+        set_http_pool_size(parallel)
+    if parallel > FTP_POOL_SIZE:
+        FTP_POOL_SIZE = parallel
+
+
+def set_segments(segments, threshold_mb):
+    if segments < 1:
+        sys.stderr.write('ERROR: Number of segments must be at least 1\n')
+        sys.exit(1)
+    if threshold_mb < 0:
+        sys.stderr.write('ERROR: Segment threshold cannot be negative\n')
+        sys.exit(1)
+    global SEGMENTS, SEGMENT_THRESHOLD
+    SEGMENTS = segments
+    SEGMENT_THRESHOLD = threshold_mb * 1024 * 1024
+    if PARALLEL_TRANSFERS * segments > HTTP_POOL_SIZE:
+        set_http_pool_size(PARALLEL_TRANSFERS * segments)
+
+
+def set_transfer_order(order):
+    global TRANSFER_ORDER
+    TRANSFER_ORDER = order
+
+
+def set_parallel_accessions(parallel):
+    if parallel < 1:
+        sys.stderr.write('ERROR: Number of accessions processed in parallel must be at least 1\n')
+        sys.exit(1)
+    global PARALLEL_ACCESSIONS
+    PARALLEL_ACCESSIONS = parallel
+    if parallel > HTTP_POOL_SIZE:
+        set_http_pool_size(parallel)
+
+
+def set_async_transfers(enabled, concurrency):
+    if concurrency < 1:
+        sys.stderr.write('ERROR: Number of concurrent requests must be at least 1\n')
+        sys.exit(1)
+    global ASYNC_TRANSFERS, ASYNC_CONCURRENCY
+    ASYNC_CONCURRENCY = concurrency
+    if enabled:
+        import asyncUtils
+        if not asyncUtils.is_supported():
+            print('aiohttp is not installed. Defaulting to blocking transfers')
+            enabled = False
+    ASYNC_TRANSFERS = enabled
+
+
+def transfer_slot():
+    # held for the duration of each file transfer, so that no more than PARALLEL_TRANSFERS
+    # files are in flight however many accessions are being processed at once
+    return _transfer_slots
+
+
+def get_overall_status(statuses):
+    if FAILED in statuses:
+        return FAILED
+    if DOWNLOADED in statuses:
+        return DOWNLOADED
+    return SKIPPED
+
+
+def print_status_table(results):
+    print('Accession\tStatus')
+    for accession, status in results:
+        print('{0}\t{1}'.format(accession, status))
+    print_status_summary([status for accession, status in results])
+
+
+def print_status_summary(statuses):
+    print('{0} downloaded, {1} skipped, {2} failed'.format(
+        statuses.count(DOWNLOADED), statuses.count(SKIPPED), statuses.count(FAILED)))
+
+
+class ThreadOutput(object):
+    # stands in for sys.stdout/sys.stderr: writes made by a worker thread are held
+    # in that thread's buffer so they can be printed later without interleaving
+    def __init__(self, stream, stream_name):
+        self.stream = stream
+        self.stream_name = stream_name
+
+    def write(self, text):
+        buffer = getattr(_thread_output, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append((self.stream_name, text))
+        return len(text)
+
+    def flush(self):
+        if getattr(_thread_output, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def capture_thread_output():
+    with _thread_output_lock:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout, 'stdout')
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr, 'stderr')
+
+
+def run_captured(func, args):
+    output = []
+    _thread_output.buffer = output
+    try:
+        result = func(*args)
+        error = None
+    except Exception as e:
+        result = None
+        error = e
+    finally:
+        _thread_output.buffer = None
+    return output, result, error
+
+
+def run_in_order(func, args_list, workers):
+    # runs func for each argument tuple on up to workers threads, returning the results
+    # and printing the console output of each call in the order of args_list
+    if workers <= 1 or len(args_list) <= 1:
+        return [func(*args) for args in args_list]
+    capture_thread_output()
+    results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_captured, func, args) for args in args_list]
+        for future in futures:
+            output, result, error = future.result()
+            for stream_name, text in output:
+                getattr(sys, stream_name).write(text)
+            if error is not None:
+                for pending in futures:
+                    pending.cancel()
+                raise error
+            results.append(result)
+    return results
+
+
 def get_wgs_file_ext(output_format):
     if output_format == EMBL_FORMAT:
         return WGS_EMBL_EXT
@@ -487,15 +1528,87 @@ def get_wgs_ftp_url(wgs_set, status, output_format):
     return base_url + get_wgs_file_ext(output_format)
 
 
+def get_listing_cache_file(host, port, directory):
+    name = '{0}_{1}{2}'.format(host, port, directory).replace('/', '_')
+    return os.path.join(CACHE_DIR, 'ftp_listings', name + '.txt')
+
+
+def read_cached_listing(cache_file):
+    try:
+        if time.time() - os.path.getmtime(cache_file) > FTP_LISTING_TTL:
+            return None
+        with open(cache_file) as f:
+            return f.read().splitlines()
+    except OSError:
+        return None
+
+
+def write_cached_listing(cache_file, names):
+    # the cache is only an optimisation, so a cache directory that cannot be written is ignored
+    try:
+        create_dir(os.path.dirname(cache_file))
+        with open(cache_file + PART_EXT, 'w') as f:
+            f.write(''.join(name + '\n' for name in names))
+        os.replace(cache_file + PART_EXT, cache_file)
+    except OSError:
+        pass
+
+
+def get_ftp_listing(host, port, directory):
+    # names of the files in an FTP directory. Each directory is listed at most once
+    # per run, and listings are kept on disk for FTP_LISTING_TTL seconds
+    key = (host, port, directory)
+    with _ftp_listings_lock:
+        if key in _ftp_listings:
+            return _ftp_listings[key]
+        directory_lock = _ftp_listing_locks.setdefault(key, threading.Lock())
+    with directory_lock:
+        with _ftp_listings_lock:
+            if key in _ftp_listings:
+                return _ftp_listings[key]
+        cache_file = get_listing_cache_file(host, port, directory)
+        names = read_cached_listing(cache_file)
+        if names is None:
+            with ftp_connection(host, port) as ftp:
+                names = [f.split('/')[-1] for f in ftp.nlst(directory)]
+                # NLST switches the connection to ASCII mode
+                ftp.voidcmd('TYPE I')
+            write_cached_listing(cache_file, names)
+            with _ftp_listings_lock:
+                _ftp_listings_listed.add(key)
+        with _ftp_listings_lock:
+            _ftp_listings[key] = names
+        return names
+
+
+def drop_cached_ftp_listing(host, port, directory):
+    # forgets a listing read from the disk cache, so that the directory is listed again.
+    # Returns False if it was listed in this run, as listing it again would not help
+    key = (host, port, directory)
+    with _ftp_listings_lock:
+        if key in _ftp_listings_listed:
+            return False
+        _ftp_listings.pop(key, None)
+    try:
+        os.remove(get_listing_cache_file(host, port, directory))
+    except OSError:
+        pass
+    return True
+
+
+def get_nonversioned_wgs_dir(wgs_set, status):
+    host, port, wgs_dir = split_ftp_url(WGS_FTP_BASE)
+    return host, port, wgs_dir + '/' + status + '/' + wgs_set[:3].lower()
+
+
+def drop_cached_wgs_listing(wgs_set, status):
+    return drop_cached_ftp_listing(*get_nonversioned_wgs_dir(wgs_set, status))
+
+
 def get_nonversioned_wgs_ftp_url(wgs_set, status, output_format):
-    ftp_url = 'ftp.ebi.ac.uk'
-    base_dir = WGS_FTP_DIR + '/' + status + '/' + wgs_set[:3].lower()
+    host, port, base_dir = get_nonversioned_wgs_dir(wgs_set, status)
     base_url = WGS_FTP_BASE + '/' + status + '/' + wgs_set[:3].lower()
-    ftp = ftplib.FTP(ftp_url)
-    ftp.login()
-    ftp.cwd(base_dir)
-    supp = ftp.nlst()
-    ftp.close()
+    supp = get_ftp_listing(host, port, base_dir)
     files = [f for f in supp if f.startswith(wgs_set) and f.endswith(get_wgs_file_ext(output_format))]
     if len(files) == 0:
         return None
@@ -503,19 +1616,114 @@ def get_nonversioned_wgs_ftp_url(wgs_set, status, output_format):
         return base_url + '/' + max(files)
 
 
+def set_cache(cache_dir, enabled):
+    # the response cache is opt-in: reused portal searches would miss runs and files added since
+    global CACHE_DIR, _response_cache
+    if cache_dir is not None:
+        CACHE_DIR = cache_dir
+    if _response_cache is not None:
+        _response_cache.close()
+        _response_cache = None
+    if enabled:
+        try:
+            create_dir(CACHE_DIR)
+        except OSError as e:
+            print('Unable to use cache directory {0} ({1}), responses will not be cached'.format(CACHE_DIR, e))
+            return
+        _response_cache = responseCache.open_cache(os.path.join(CACHE_DIR, RESPONSE_CACHE_FILE),
+                                                   RESPONSE_CACHE_TTL, RESPONSE_CACHE_SIZE)
+
+
+def get_cached_response(url):
+    if _response_cache is None:
+        return None
+    return _response_cache.get(url)
+
+
+def cache_response(url, body):
+    if _response_cache is not None and len(body) <= RESPONSE_CACHE_ENTRY_SIZE:
+        _response_cache.put(url, body)
+
+
+def cache_response_lines(url, lines):
+    # passes the lines on, and caches the response once it has been read to the end
+    body = [] if _response_cache is not None else None
+    size = 0
+    for line in lines:
+        if body is not None:
+            size += len(line)
+            if size <= RESPONSE_CACHE_ENTRY_SIZE:
+                body.append(line)
+            else:
+                body = None
+        yield line
+    if body is not None:
+        cache_response(url, b''.join(body))
+
+
+def set_metrics(metrics_file, prometheus_file):
+    global _metrics
+    if metrics_file is None and prometheus_file is None:
+        return
+    try:
+        _metrics = metrics.MetricsWriter(metrics_file, prometheus_file)
+    except OSError as e:
+        sys.stderr.write('ERROR: Unable to open metrics file {0}: {1}\n'.format(metrics_file, e))
+        sys.exit(1)
+    # the Prometheus snapshot is written on the way out, whether or not the run succeeded
+    atexit.register(_metrics.close)
+
+
+def get_protocol(url):
+    return url.split('://')[0] if '://' in url else None
+
+
+def get_transferred_size(dest_file, offset):
+    # bytes written to dest_file (or its .part file, if the transfer did not complete) since offset
+    if os.path.isfile(dest_file):
+        size = os.path.getsize(dest_file)
+    else:
+        size = get_part_size(dest_file + PART_EXT)
+    return max(size - offset, 0)
+
+
+def get_md5_outcome(success):
+    return 'match' if success else 'mismatch'
+
+
+def record_transfer(url, protocol, start, transferred, accession=None, retries=0, md5=None, error=None, **fields):
+    # error is the exception the transfer failed with, or the name of the failure
+    if _metrics is None:
+        return
+    duration = time.time() - start
+    event = {'accession': accession, 'url': url, 'protocol': protocol, 'bytes': transferred,
+             'duration': round(duration, 3), 'throughput': round(transferred / duration) if duration > 0 else None,
+             'retries': retries, 'md5': md5,
+             'error': error if error is None or isinstance(error, str) else type(error).__name__}
+    event.update(fields)
+    _metrics.record(event)
+
+
+def print_cache_summary():
+    if _response_cache is not None and _response_cache.hits + _response_cache.misses > 0:
+        print('Response cache: {0} hits, {1} misses'.format(_response_cache.hits, _response_cache.misses))
+
+
 def get_report_from_portal(url):
+    body = get_cached_response(url)
+    if body is not None:
+        return iter(io.BytesIO(body))
     try:
-        request = urlrequest.Request(url)
-        response = urlrequest.urlopen(request)
-        if response.status == 200:
-            return response
-        elif response.status == 204:
+        response = http_get(url, stream=True)
+        if response.status_code == 200:
+            return cache_response_lines(url, get_response_lines(response))
+        elif response.status_code == 204:
             sys.stderr.write('ERROR: No records of the requested data group are available associated with the provided accession')
         else:
-            sys.stderr.write('ERROR: ' + response.msg + '\n')
+            sys.stderr.write('ERROR: ' + response.reason + '\n')
             sys.stderr.write('ERROR: Unable to fetch data from url: ' + url + '\n')
         sys.exit(1)
-    except urlerror.URLError as e:
+    except (urlerror.URLError, requests.exceptions.SSLError) as e:
         print_certificate_failed_error(e)
     except Exception as e:
         raise
@@ -523,39 +1731,102 @@ def get_report_from_portal(url):
 
 def download_report_from_portal(url):
     response = get_report_from_portal(url)
-    return json.loads(response.read().decode('utf-8'))
+    return json.loads(b''.join(response).decode('utf-8'))
 
 
-def get_accession_query(accession):
-    query = 'query='
+def get_accession_field(accession):
+    # the portal field a run, experiment, analysis or sample accession is looked up by
     if is_run(accession):
-        query += 'run_accession=%22{0}%22'.format(accession)
+        return 'run_accession'
     elif is_experiment(accession):
-        query += 'experiment_accession=%22{0}%22'.format(accession)
+        return 'experiment_accession'
     elif is_analysis(accession):
-        query += 'analysis_accession=%22{0}%22'.format(accession)
+        return 'analysis_accession'
     elif is_sample(accession):
-        query += 'sample_accession=%22{0}%22'.format(accession)
+        return 'sample_accession'
+    return None
+
+
+def get_accession_query(accession):
+    query = 'query='
+    field = get_accession_field(accession)
+    if field is not None:
+        query += '{0}=%22{1}%22'.format(field, accession)
     return query
 
 
+def search_portal(params):
+    # a portal search sent as a form, for queries too long for a URL. The response is
+    # cached as that of the same search made with GET
+    url = PORTAL_SEARCH_BASE + urlparse.urlencode(params)
+    body = get_cached_response(url)
+    if body is None:
+        response = http_post(PORTAL_SEARCH_BASE.rstrip('?'), params)
+        if response.status_code == 204:
+            return []
+        response.raise_for_status()
+        body = response.content
+        cache_response(url, body)
+    return json.loads(body.decode('utf-8'))
+
+
+def get_file_search_batch_params(accessions, aspera):
+    # one search for the files of many accessions of the same result, ORed together; the
+    # fields they are looked up by are returned too, for the rows to be told apart
+    key_fields = sorted(set(get_accession_field(accession) for accession in accessions))
+    if 'sample_accession' in key_fields:
+        key_fields.append('secondary_sample_accession')
+    query = ' OR '.join('{0}="{1}"'.format(get_accession_field(accession), accession) for accession in accessions)
+    fields = get_file_fields(accessions[0], aspera)[len('fields='):]
+    params = {'query': query, 'result': get_result(accessions[0])[len('result='):],
+              'fields': fields + ',' + ','.join(key_fields), 'format': 'json', 'limit': '0'}
+    return params, key_fields
+
+
+def get_file_search_results(accessions, aspera):
+    # the file search rows of each of many run, experiment, sample or analysis accessions,
+    # from one portal search per PORTAL_SEARCH_BATCH_SIZE of them instead of one each.
+    # Accessions of a batch that failed are left out, to be searched for on their own
+    accessions_by_result = {}
+    for accession in accessions:
+        accessions_by_result.setdefault(get_result(accession), []).append(accession)
+    results = {}
+    for result_accessions in accessions_by_result.values():
+        for batch in split_batches(result_accessions, PORTAL_SEARCH_BATCH_SIZE):
+            params, key_fields = get_file_search_batch_params(batch, aspera)
+            try:
+                rows = search_portal(params)
+            except (requests.exceptions.RequestException, IOError, ValueError) as e:
+                sys.stderr.write('ERROR: Portal search for {0} accessions failed, they will be searched for '
+                                 'one at a time: {1}\n'.format(len(batch), e))
+                continue
+            batch_results = dict((accession, []) for accession in batch)
+            for row in rows:
+                # a run may belong to both an experiment and a sample of the batch
+                for accession in set(row.get(field) for field in key_fields):
+                    if accession in batch_results:
+                        batch_results[accession].append(row)
+            results.update(batch_results)
+    return results
+
+
 def get_ftp_file_fields(accession):
     fields = 'fields='
-    fields += SUBMITTED_FIELD + ',' + SUBMITTED_MD5_FIELD
+    fields += SUBMITTED_FIELD + ',' + SUBMITTED_MD5_FIELD + ',' + SUBMITTED_BYTES_FIELD
     if is_analysis(accession):
         return fields
-    fields += ',' + SRA_FIELD + ',' + SRA_MD5_FIELD
-    fields += ',' + FASTQ_FIELD + ',' + FASTQ_MD5_FIELD
+    fields += ',' + SRA_FIELD + ',' + SRA_MD5_FIELD + ',' + SRA_BYTES_FIELD
+    fields += ',' + FASTQ_FIELD + ',' + FASTQ_MD5_FIELD + ',' + FASTQ_BYTES_FIELD
     return fields
 
 
 def get_aspera_file_fields(accession):
     fields = 'fields='
-    fields += SUBMITTED_ASPERA_FIELD + ',' + SUBMITTED_MD5_FIELD
+    fields += SUBMITTED_ASPERA_FIELD + ',' + SUBMITTED_MD5_FIELD + ',' + SUBMITTED_BYTES_FIELD
     if is_analysis(accession):
         return fields
-    fields += ',' + SRA_ASPERA_FIELD + ',' + SRA_MD5_FIELD
-    fields += ',' + FASTQ_ASPERA_FIELD + ',' + FASTQ_MD5_FIELD
+    fields += ',' + SRA_ASPERA_FIELD + ',' + SRA_MD5_FIELD + ',' + SRA_BYTES_FIELD
+    fields += ',' + FASTQ_ASPERA_FIELD + ',' + FASTQ_MD5_FIELD + ',' + FASTQ_BYTES_FIELD
     return fields
 
 
@@ -566,6 +1837,15 @@ def get_file_fields(accession, aspera):
         return get_ftp_file_fields(accession)
 
 
+def get_manifest_file_fields(analysis):
+    # the FTP and Aspera locations of each file with its MD5 and size, for a transfer manifest
+    fields = [SUBMITTED_FIELD, SUBMITTED_ASPERA_FIELD, SUBMITTED_MD5_FIELD, SUBMITTED_BYTES_FIELD]
+    if not analysis:
+        fields += [SRA_FIELD, SRA_ASPERA_FIELD, SRA_MD5_FIELD, SRA_BYTES_FIELD]
+        fields += [FASTQ_FIELD, FASTQ_ASPERA_FIELD, FASTQ_MD5_FIELD, FASTQ_BYTES_FIELD]
+    return ','.join(fields)
+
+
 def get_result(accession):
     if is_run(accession) or is_experiment(accession) or is_sample(accession):
         return RUN_RESULT
@@ -593,12 +1873,23 @@ def get_file_search_query(accession, aspera):
         get_file_fields(accession, aspera) + '&format=json&limit=0'
 
 
+def get_manifest_search_query(accession):
+    return PORTAL_SEARCH_BASE + get_accession_query(accession) + '&' + get_result(accession) + '&fields=' + \
+        get_manifest_file_fields(is_analysis(accession)) + '&format=json&limit=0'
+
+
 def split_filelist(filelist_string):
     if filelist_string.strip() == '':
         return []
     return filelist_string.strip().split(';')
 
 
+def split_sizelist(sizelist_string, file_cnt):
+    # file sizes in bytes, None where the portal did not give one
+    sizes = [int(size) if size.isdigit() else None for size in split_filelist(sizelist_string or '')]
+    return (sizes + [None] * file_cnt)[:file_cnt]
+
+
 def parse_file_search_result_line(item, accession, output_format, aspera):
     # example:
     # submitted_ftp submitted_md5 sra_ftp sra_md5 fastq_ftp fastq_md5 run_accession
@@ -619,19 +1910,23 @@ def parse_file_search_result_line(item, accession, output_format, aspera):
 
     if aspera:
         sub_filelist = split_filelist(item[SUBMITTED_ASPERA_FIELD])
-        sra_filelist = split_filelist(item[SRA_ASPERA_FIELD])
-        fastq_filelist = split_filelist(item[FASTQ_ASPERA_FIELD])
+        sra_filelist = split_filelist(item.get(SRA_ASPERA_FIELD, ''))
+        fastq_filelist = split_filelist(item.get(FASTQ_ASPERA_FIELD, ''))
     else:
         sub_filelist = split_filelist(item[SUBMITTED_FIELD])
-        sra_filelist = split_filelist(item[SRA_FIELD])
-        fastq_filelist = split_filelist(item[FASTQ_FIELD])
+        sra_filelist = split_filelist(item.get(SRA_FIELD, ''))
+        fastq_filelist = split_filelist(item.get(FASTQ_FIELD, ''))
 
     sub_md5list = split_filelist(item[SUBMITTED_MD5_FIELD])
-    sra_md5list = split_filelist(item[SRA_MD5_FIELD])
-    fastq_md5list = split_filelist(item[FASTQ_MD5_FIELD])
+    sra_md5list = split_filelist(item.get(SRA_MD5_FIELD, ''))
+    fastq_md5list = split_filelist(item.get(FASTQ_MD5_FIELD, ''))
+
+    sub_sizelist = split_sizelist(item.get(SUBMITTED_BYTES_FIELD), len(sub_filelist))
+    sra_sizelist = split_sizelist(item.get(SRA_BYTES_FIELD), len(sra_filelist))
+    fastq_sizelist = split_sizelist(item.get(FASTQ_BYTES_FIELD), len(fastq_filelist))
 
     if is_analysis(accession):
-        return data_acc, sub_filelist, sub_md5list
+        return data_acc, sub_filelist, sub_md5list, sub_sizelist
     if output_format is None:
         if len(sub_filelist) > 0:
             output_format = SUBMITTED_FORMAT
@@ -640,16 +1935,15 @@ def parse_file_search_result_line(item, accession, output_format, aspera):
         else:
             output_format = FASTQ_FORMAT
     if output_format == SUBMITTED_FORMAT:
-        return data_acc, sub_filelist, sub_md5list
+        return data_acc, sub_filelist, sub_md5list, sub_sizelist
     elif output_format == SRA_FORMAT:
-        return data_acc, sra_filelist, sra_md5list
+        return data_acc, sra_filelist, sra_md5list, sra_sizelist
     else:
-        return data_acc, fastq_filelist, fastq_md5list
+        return data_acc, fastq_filelist, fastq_md5list, fastq_sizelist
 
 
 def create_dir(dir_path):
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    os.makedirs(dir_path, exist_ok=True)
 
 
 def get_group_query(accession, subtree):
@@ -697,6 +1991,43 @@ def get_group_search_query(group, result, accession, subtree):
         + result + '&' + get_group_fields(group) + '&limit=0'
 
 
+def get_group_file_search_query(group, accession, subtree, aspera):
+    # file URLs, MD5s and sizes of every run or analysis of a read or analysis group
+    return PORTAL_SEARCH_BASE + get_group_query(accession, subtree) + '&' + get_group_result(group) + '&' \
+        + get_group_file_fields(group, aspera) + '&format=json&limit=0'
+
+
+def get_group_file_search_results(group, accession, subtree, aspera):
+    # the file search rows of each run or analysis of a read or analysis group, from one portal search
+    result_accession = 'analysis_accession' if group == ANALYSIS else 'run_accession'
+    results = {}
+    for item in download_report_from_portal(get_group_file_search_query(group, accession, subtree, aspera)):
+        results.setdefault(item[result_accession], []).append(item)
+    return results
+
+
+def get_group_file_fields(group, aspera):
+    # the fields of get_file_fields, for the runs or analyses of a group
+    if aspera:
+        url_fields = [SUBMITTED_ASPERA_FIELD, SRA_ASPERA_FIELD, FASTQ_ASPERA_FIELD]
+    else:
+        url_fields = [SUBMITTED_FIELD, SRA_FIELD, FASTQ_FIELD]
+    md5_fields = [SUBMITTED_MD5_FIELD, SRA_MD5_FIELD, FASTQ_MD5_FIELD]
+    size_fields = [SUBMITTED_BYTES_FIELD, SRA_BYTES_FIELD, FASTQ_BYTES_FIELD]
+    fields = 'fields=' + ('analysis_accession' if group == ANALYSIS else 'run_accession')
+    # analyses only have submitted files
+    for i in range(1 if group == ANALYSIS else 3):
+        fields += ',' + url_fields[i] + ',' + md5_fields[i] + ',' + size_fields[i]
+    return fields
+
+
+def get_group_manifest_search_query(group, accession, subtree):
+    fields = 'fields=' + ('analysis_accession' if group == ANALYSIS else 'run_accession') + ',' \
+        + get_manifest_file_fields(group == ANALYSIS)
+    return PORTAL_SEARCH_BASE + get_group_query(accession, subtree) + '&' + get_group_result(group) + '&' \
+        + fields + '&format=json&limit=0'
+
+
 def get_experiment_search_query(run_accession):
     return PORTAL_SEARCH_BASE + 'query=run_accession=%22' + run_accession + '%22' \
         + '&result=read_run&fields=experiment_accession&limit=0'
@@ -732,13 +2063,42 @@ def record_start_line(line, output_format):
         return False
 
 
-def extract_acc_from_line(line, output_format):
-    if output_format == FASTA_FORMAT:
-        return line.split(b'|')[1]
-    elif output_format == EMBL_FORMAT:
-        return line.split()[1][:-1]
+def get_header_accession(line):
+    # unversioned accession from either an EMBL ID line or an ENA FASTA header
+    if line.startswith(b'>'):
+        fields = line.split(b'|')
+        accession = fields[1] if len(fields) > 1 else line[1:].split()[0]
+    elif line.startswith(b'ID   '):
+        accession = line.split()[1].rstrip(b';')
     else:
-        return ''
+        return None
+    return accession.split(b'.')[0]
+
+
+def find_header_lines(block):
+    # (offset, line) for each EMBL ID line or FASTA header in a block starting on a line boundary.
+    # matching the preceding newline is much faster than a multiline '^' anchor
+    if block.startswith(b'>') or block.startswith(b'ID   '):
+        yield 0, block[:block.find(b'\n') if b'\n' in block else len(block)]
+    for match in header_line_pattern.finditer(block):
+        yield match.start() + 1, match.group()[1:]
+
+
+def read_line_blocks(f, block_size):
+    # reads f in large blocks, each ending on a line boundary
+    pending = b''
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = pending + data
+        end = data.rfind(b'\n') + 1
+        pending = data[end:]
+        if end > 0:
+            yield data[:end]
+    if pending:
+        yield pending
+
 
 def print_certificate_failed_error(e):
     if sys.platform == 'darwin' and 'CERTIFICATE_VERIFY_FAILED' in str(e):
@@ -0,0 +1,259 @@
+#
+# wgsIndex.py
+#
+#
+# Copyright 2017 EMBL-EBI, Hinxton outstation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Random access to records of downloaded WGS set files.
+#
+# A WGS set file is recompressed in place as BGZF: a series of independent gzip
+# members holding at most 64 KB of data each. The result is still a valid gzip
+# file, so everything reading it with gzip keeps working, and two sidecar files
+# are written next to it:
+#   <file>.gzi  the compressed and uncompressed offset of every block (the bgzip index format)
+#   <file>.idx  accession, uncompressed offset and length of every record, tab separated,
+#               after a header line with the size and modification time of the file indexed
+# Any record can then be read by decompressing only the blocks it spans.
+
+import argparse
+import bisect
+import gzip
+import os
+import struct
+import sys
+import zlib
+
+import utils
+
+BGZF_BLOCK_SIZE = 65280  # uncompressed bytes per block, as written by bgzip
+BGZF_MAX_BLOCK_SIZE = 65536
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+BGZF_EOF = BGZF_HEADER + b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+COMPRESSION_LEVEL = 6
+
+GZI_EXT = '.gzi'
+IDX_EXT = '.idx'
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+IDX_HEADER_FORMAT = '#{0:020d}\t{1:020d}\n'  # fixed width, so it can be filled in once the file is in place
+
+
+def get_block_index_path(wgs_file_path):
+    return wgs_file_path + GZI_EXT
+
+
+def get_record_index_path(wgs_file_path):
+    return wgs_file_path + IDX_EXT
+
+
+def get_idx_header(wgs_file_path):
+    stat = os.stat(wgs_file_path)
+    return IDX_HEADER_FORMAT.format(stat.st_size, stat.st_mtime_ns)
+
+
+def has_index(wgs_file_path):
+    # an index whose header does not match the WGS set file belongs to an earlier download of it
+    record_index_path = get_record_index_path(wgs_file_path)
+    if not os.path.isfile(get_block_index_path(wgs_file_path)) or not os.path.isfile(record_index_path):
+        return False
+    with open(record_index_path) as f:
+        return f.readline() == get_idx_header(wgs_file_path)
+
+
+def compress_block(data):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = len(BGZF_HEADER) + 2 + len(deflated) + 8
+    if block_size > BGZF_MAX_BLOCK_SIZE:
+        # incompressible data can grow beyond what a block may hold
+        half = len(data) // 2
+        return compress_block(data[:half]) + compress_block(data[half:])
+    return BGZF_HEADER + struct.pack('<H', block_size - 1) + deflated \
+        + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    # writes BGZF blocks and keeps the offsets needed for the .gzi index
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = bytearray()
+        self.compressed_offset = 0
+        self.uncompressed_offset = 0
+        self.block_offsets = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.flush_block(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def flush_block(self, data):
+        block = compress_block(data)
+        self.f.write(block)
+        self.compressed_offset += len(block)
+        self.uncompressed_offset += len(data)
+        self.block_offsets.append((self.compressed_offset, self.uncompressed_offset))
+
+    def close(self):
+        if self.buffer:
+            self.flush_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.f.write(BGZF_EOF)
+        # the start of the first block is implicit, and the end of the last one is not a block start
+        if self.block_offsets:
+            self.block_offsets.pop()
+
+
+def write_block_index(block_index_path, block_offsets):
+    with open(block_index_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(block_offsets)))
+        for compressed_offset, uncompressed_offset in block_offsets:
+            f.write(struct.pack('<QQ', compressed_offset, uncompressed_offset))
+
+
+def read_block_index(block_index_path):
+    with open(block_index_path, 'rb') as f:
+        entry_cnt = struct.unpack('<Q', f.read(8))[0]
+        data = f.read(16 * entry_cnt)
+    compressed_offsets = [0]
+    uncompressed_offsets = [0]
+    for compressed_offset, uncompressed_offset in struct.iter_unpack('<QQ', data):
+        compressed_offsets.append(compressed_offset)
+        uncompressed_offsets.append(uncompressed_offset)
+    return compressed_offsets, uncompressed_offsets
+
+
+def build_index(wgs_file_path, quiet=False):
+    if not quiet:
+        print('Building random-access index for ' + os.path.basename(wgs_file_path))
+    temp_file_path = wgs_file_path + utils.PART_EXT
+    record_index_path = get_record_index_path(wgs_file_path)
+    record_cnt = 0
+    with gzip.open(wgs_file_path, 'rb') as f, open(temp_file_path, 'wb') as out, \
+            open(record_index_path + utils.PART_EXT, 'w') as index:
+        index.write(IDX_HEADER_FORMAT.format(0, 0))
+        writer = BgzfWriter(out)
+        record = None
+        for block in utils.read_line_blocks(f, READ_BLOCK_SIZE):
+            for header_start, header in utils.find_header_lines(block):
+                record_offset = writer.uncompressed_offset + len(writer.buffer) + header_start
+                if record is not None:
+                    index.write('{0}\t{1}\t{2}\n'.format(record[0], record[1], record_offset - record[1]))
+                record = (utils.get_header_accession(header).decode(), record_offset)
+                record_cnt += 1
+            writer.write(block)
+        writer.close()
+        if record is not None:
+            end_offset = writer.uncompressed_offset
+            index.write('{0}\t{1}\t{2}\n'.format(record[0], record[1], end_offset - record[1]))
+    # the set file goes into place first, so that the index can record its size and modification time
+    os.replace(temp_file_path, wgs_file_path)
+    with open(record_index_path + utils.PART_EXT, 'r+') as index:
+        index.write(get_idx_header(wgs_file_path))
+    write_block_index(get_block_index_path(wgs_file_path), writer.block_offsets)
+    os.replace(record_index_path + utils.PART_EXT, record_index_path)
+    if not quiet:
+        print('Indexed {0} records'.format(record_cnt))
+    return record_cnt
+
+
+def find_records(wgs_file_path, accessions):
+    # (accession, offset, length) of the requested records, in file order
+    wanted = set(a.split('.')[0] for a in accessions)
+    records = []
+    with open(get_record_index_path(wgs_file_path)) as f:
+        f.readline()
+        for line in f:
+            accession, offset, length = line.rstrip('\n').split('\t')
+            if accession in wanted:
+                records.append((accession, int(offset), int(length)))
+                wanted.discard(accession)
+                if not wanted:
+                    break
+    records.sort(key=lambda r: r[1])
+    return records
+
+
+def read_block(f):
+    header = f.read(len(BGZF_HEADER) + 2)
+    if len(header) < len(BGZF_HEADER) + 2:
+        return None
+    block_size = struct.unpack('<H', header[-2:])[0] + 1
+    rest = f.read(block_size - len(header))
+    return zlib.decompress(rest[:-8], -15)
+
+
+def read_range(f, block_offsets, offset, length):
+    compressed_offsets, uncompressed_offsets = block_offsets
+    i = bisect.bisect_right(uncompressed_offsets, offset) - 1
+    f.seek(compressed_offsets[i])
+    skip = offset - uncompressed_offsets[i]
+    data = bytearray()
+    while len(data) < skip + length:
+        block = read_block(f)
+        if block is None:
+            break
+        data += block
+    return bytes(data[skip:skip + length])
+
+
+def fetch_records(wgs_file_path, accessions, dest_file):
+    # writes the requested records to dest_file and returns the accessions not found
+    records = find_records(wgs_file_path, accessions)
+    block_offsets = read_block_index(get_block_index_path(wgs_file_path))
+    with open(wgs_file_path, 'rb') as f:
+        for accession, offset, length in records:
+            dest_file.write(read_range(f, block_offsets, offset, length))
+    found = set(r[0] for r in records)
+    return [a for a in accessions if a.split('.')[0] not in found]
+
+
+def set_parser():
+    parser = argparse.ArgumentParser(prog='wgsIndex',
+                                     description='Index a downloaded WGS set file and fetch records from it by accession')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build', help='Recompress a WGS set file as BGZF and index its records')
+    build_parser.add_argument('wgs_file', help='WGS set file (.dat.gz or .fasta.gz)')
+    get_parser = subparsers.add_parser('get', help='Fetch records from an indexed WGS set file')
+    get_parser.add_argument('wgs_file', help='Indexed WGS set file (.dat.gz or .fasta.gz)')
+    get_parser.add_argument('accessions', nargs='+', help='Accessions of the records to fetch')
+    get_parser.add_argument('-o', '--output', default=None,
+                            help='File to write the records to (default is standard output)')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = set_parser()
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.wgs_file)
+    elif args.command == 'get':
+        if not has_index(args.wgs_file):
+            sys.stderr.write('ERROR: No index found for {0}, please run the build command first\n'.format(
+                args.wgs_file))
+            sys.exit(1)
+        if args.output is not None:
+            with open(args.output, 'wb') as output:
+                missing = fetch_records(args.wgs_file, args.accessions, output)
+        else:
+            missing = fetch_records(args.wgs_file, args.accessions, sys.stdout.buffer)
+        if len(missing) > 0:
+            sys.stderr.write('ERROR: Records not found: {0}\n'.format(','.join(missing)))
+            sys.exit(1)
+    else:
+        parser.print_help()
+        sys.exit(1)